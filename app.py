@@ -4,17 +4,29 @@ Procesa exportaciones de Shopify y genera listas de compras y armado.
 Diseñado e implementado por Flipit.media
 """
 
-from fastapi import FastAPI, UploadFile, File, Request, Form, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi import FastAPI, UploadFile, File, Request, Form, HTTPException, BackgroundTasks
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+import asyncio
 import csv
 import io
 import re
+import shutil
+import signal
+import zlib
 from datetime import datetime, date, timedelta
-from typing import Optional
+from typing import List, Optional
 import json
+import logging
+import multiprocessing
 import os
+import hashlib
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 # Para generar Excel
@@ -26,30 +38,172 @@ from openpyxl.utils import get_column_letter
 import sqlite3
 
 app = FastAPI(title="Sistema Gestión La Vega")
+logger = logging.getLogger(__name__)
 
 # Configurar archivos estáticos y templates
 BASE_DIR = Path(__file__).resolve().parent
 app.mount("/static", StaticFiles(directory=BASE_DIR / "static"), name="static")
 templates = Jinja2Templates(directory=BASE_DIR / "templates")
 
-# Directorio para archivos generados
-OUTPUT_DIR = BASE_DIR / "outputs"
-OUTPUT_DIR.mkdir(exist_ok=True)
+# Directorio para archivos generados (configurable para pruebas)
+OUTPUT_DIR = Path(os.environ.get("VEGA_OUTPUT_DIR", BASE_DIR / "outputs"))
 
-DB_PATH = BASE_DIR / "vega.db"
+DB_PATH = Path(os.environ.get("VEGA_DB_PATH", BASE_DIR / "vega.db"))
 
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
+def get_db(check_same_thread: bool = True):
+    conn = sqlite3.connect(DB_PATH, check_same_thread=check_same_thread)
     conn.row_factory = sqlite3.Row
     return conn
 
 
+def en_lotes(valores: list, tamano: int = 500):
+    """Divide una lista en lotes (SQLite limita la cantidad de parámetros por consulta)."""
+    for i in range(0, len(valores), tamano):
+        yield valores[i:i + tamano]
+
+
+def _telefono_busqueda(telefono: Optional[str]) -> str:
+    """Agrega variantes solo-dígitos del teléfono para que se pueda buscar sin formato."""
+    if not telefono:
+        return ''
+    digitos = re.sub(r'\D', '', telefono)
+    variantes = [telefono]
+    for v in (digitos, digitos[-9:], digitos[-8:]):
+        if v and v not in variantes:
+            variantes.append(v)
+    return ' '.join(variantes)
+
+
+def indexar_busqueda(cursor, pedido_ids: Optional[list] = None):
+    """
+    Actualiza el índice de búsqueda (pedidos_fts) para los pedidos indicados.
+    Sin pedido_ids reconstruye el índice completo.
+    """
+    consulta = '''
+        SELECT p.id, p.order_number, p.nombre_cliente, p.email, p.telefono, p.direccion, p.comuna,
+               (SELECT group_concat(lp.producto, ' | ') FROM lineas_pedido lp WHERE lp.pedido_id = p.id) AS productos
+        FROM pedidos p
+    '''
+    if pedido_ids is None:
+        cursor.execute("DELETE FROM pedidos_fts")
+        lotes = [None]
+    else:
+        lotes = list(en_lotes(list(pedido_ids)))
+    
+    for lote in lotes:
+        if lote is None:
+            cursor.execute(consulta)
+        else:
+            placeholders = ','.join('?' * len(lote))
+            cursor.execute(f"DELETE FROM pedidos_fts WHERE rowid IN ({placeholders})", lote)
+            cursor.execute(consulta + f" WHERE p.id IN ({placeholders})", lote)
+        filas = [
+            (row['id'], row['order_number'], row['nombre_cliente'], row['email'],
+             _telefono_busqueda(row['telefono']), row['direccion'], row['comuna'], row['productos'])
+            for row in cursor.fetchall()
+        ]
+        cursor.executemany('''
+            INSERT INTO pedidos_fts (rowid, order_number, nombre_cliente, email, telefono, direccion, comuna, productos)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', filas)
+
+
+def desindexar_busqueda(cursor, pedido_ids: list):
+    """Quita pedidos eliminados del índice de búsqueda."""
+    for lote in en_lotes(list(pedido_ids)):
+        placeholders = ','.join('?' * len(lote))
+        cursor.execute(f"DELETE FROM pedidos_fts WHERE rowid IN ({placeholders})", lote)
+
+
+def acumular_demanda(cursor, pedido_ids: list, signo: int = 1):
+    """
+    Suma (signo=1) o resta (signo=-1) la demanda de los pedidos indicados en
+    demanda_diaria. Para mover un pedido se resta antes del cambio y se suma después.
+    """
+    for lote in en_lotes(list(pedido_ids)):
+        placeholders = ','.join('?' * len(lote))
+        cursor.execute(f'''
+            INSERT INTO demanda_diaria (fecha, producto, comuna, cantidad, revenue, lineas)
+            SELECT p.fecha_entrega, lp.producto, COALESCE(p.comuna, ''),
+                   ? * SUM(lp.cantidad), ? * SUM(lp.cantidad * COALESCE(lp.precio, 0)), ? * COUNT(*)
+            FROM pedidos p
+            JOIN lineas_pedido lp ON lp.pedido_id = p.id
+            WHERE p.id IN ({placeholders}) AND p.fecha_entrega IS NOT NULL
+            GROUP BY p.fecha_entrega, lp.producto, COALESCE(p.comuna, '')
+            ON CONFLICT (fecha, producto, comuna) DO UPDATE SET
+                cantidad = cantidad + excluded.cantidad,
+                revenue = revenue + excluded.revenue,
+                lineas = lineas + excluded.lineas
+        ''', [signo, signo, signo] + lote)
+        
+        if signo < 0:
+            # Limpiar combinaciones que quedaron sin líneas
+            cursor.execute(f'''
+                DELETE FROM demanda_diaria
+                WHERE lineas <= 0 AND fecha IN (SELECT DISTINCT fecha_entrega FROM pedidos WHERE id IN ({placeholders}))
+            ''', lote)
+
+
+def reconstruir_demanda(cursor):
+    """Recalcula demanda_diaria completa desde pedidos y líneas."""
+    cursor.execute("DELETE FROM demanda_diaria")
+    cursor.execute('''
+        INSERT INTO demanda_diaria (fecha, producto, comuna, cantidad, revenue, lineas)
+        SELECT p.fecha_entrega, lp.producto, COALESCE(p.comuna, ''),
+               SUM(lp.cantidad), SUM(lp.cantidad * COALESCE(lp.precio, 0)), COUNT(*)
+        FROM pedidos p
+        JOIN lineas_pedido lp ON lp.pedido_id = p.id
+        WHERE p.fecha_entrega IS NOT NULL
+        GROUP BY p.fecha_entrega, lp.producto, COALESCE(p.comuna, '')
+    ''')
+
+
+def acumular_productos(cursor, pedido_ids: list, signo: int = 1):
+    """
+    Suma (signo=1) o resta (signo=-1) las líneas de los pedidos indicados en
+    productos. Se resta antes de borrar o cambiar líneas y se suma después.
+    """
+    for lote in en_lotes(list(pedido_ids)):
+        placeholders = ','.join('?' * len(lote))
+        cursor.execute(f'''
+            INSERT INTO productos (producto, lineas)
+            SELECT producto, ? * COUNT(*)
+            FROM lineas_pedido
+            WHERE pedido_id IN ({placeholders})
+            GROUP BY producto
+            ON CONFLICT (producto) DO UPDATE SET lineas = lineas + excluded.lineas
+        ''', [signo] + lote)
+        
+        if signo < 0:
+            # Limpiar productos que quedaron sin líneas
+            cursor.execute(f'''
+                DELETE FROM productos
+                WHERE lineas <= 0 AND producto IN (SELECT producto FROM lineas_pedido WHERE pedido_id IN ({placeholders}))
+            ''', lote)
+
+
+def reconstruir_productos(cursor):
+    """Recalcula productos completa desde las líneas de pedido."""
+    cursor.execute("DELETE FROM productos")
+    cursor.execute('''
+        INSERT INTO productos (producto, lineas)
+        SELECT producto, COUNT(*) FROM lineas_pedido GROUP BY producto
+    ''')
+
+
 def init_db():
-    """Inicializa la base de datos con las tablas necesarias."""
+    """Inicializa la base de datos con las tablas necesarias y los directorios de salida."""
+    OUTPUT_DIR.mkdir(exist_ok=True)
+    PRECALCULO_DIR.mkdir(exist_ok=True)
+    
     conn = get_db()
     cursor = conn.cursor()
     
+    # WAL: las descargas en streaming mantienen una lectura abierta entre bloques
+    # y con el journal por defecto bloquearían las escrituras (completar, importar...)
+    cursor.execute("PRAGMA journal_mode=WAL")
+    
     # Tabla de categorías
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS categorias (
@@ -95,6 +249,12 @@ def init_db():
     except:
         pass  # Columna ya existe
     
+    # Hash del contenido del pedido (para importación incremental)
+    try:
+        cursor.execute("ALTER TABLE pedidos ADD COLUMN content_hash TEXT")
+    except:
+        pass  # Columna ya existe
+    
     # Tabla de líneas de pedido
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS lineas_pedido (
@@ -108,6 +268,59 @@ def init_db():
         )
     ''')
     
+    try:
+        cursor.execute("ALTER TABLE lineas_pedido ADD COLUMN content_hash TEXT")
+    except:
+        pass  # Columna ya existe
+    
+    # Índices de las consultas diarias (ver query_plans.py)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_lineas_pedido_pedido_id ON lineas_pedido(pedido_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_lineas_pedido_producto ON lineas_pedido(producto)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pedidos_fecha_status ON pedidos(fecha_entrega, status)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pedidos_status_fecha ON pedidos(status, fecha_entrega)")
+    
+    # Índice de búsqueda de texto completo (rowid = pedidos.id)
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS pedidos_fts USING fts5(
+            order_number, nombre_cliente, email, telefono, direccion, comuna, productos,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''')
+    
+    # Poblar el índice si está desincronizado (DB existente o recién creado)
+    cursor.execute("SELECT (SELECT COUNT(*) FROM pedidos) != (SELECT COUNT(*) FROM pedidos_fts)")
+    if cursor.fetchone()[0]:
+        indexar_busqueda(cursor)
+    
+    # Demanda diaria por producto y comuna (rollup para analítica)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS demanda_diaria (
+            fecha DATE NOT NULL,
+            producto TEXT NOT NULL,
+            comuna TEXT NOT NULL DEFAULT '',
+            cantidad INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            lineas INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (fecha, producto, comuna)
+        ) WITHOUT ROWID
+    ''')
+    
+    # Productos con líneas de pedido (para detectar los que no tienen categoría)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS productos (
+            producto TEXT PRIMARY KEY,
+            lineas INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    
+    # Poblar los rollups en DBs existentes
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM lineas_pedido) AND NOT EXISTS (SELECT 1 FROM demanda_diaria)")
+    if cursor.fetchone()[0]:
+        reconstruir_demanda(cursor)
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM lineas_pedido) AND NOT EXISTS (SELECT 1 FROM productos)")
+    if cursor.fetchone()[0]:
+        reconstruir_productos(cursor)
+    
     # Tabla de configuración
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS configuracion (
@@ -136,6 +349,9 @@ def init_db():
         ('backup_frecuencia_dias', '3'),
         ('backup_hora', '08:00'),
         ('ultimo_backup', ''),
+        ('data_version', '0'),
+        ('precalculo_dias', '2'),
+        ('precalculo_hora', '05:30'),
     ]
     
     for clave, valor in config_default:
@@ -145,8 +361,11 @@ def init_db():
     conn.close()
 
 
-# Inicializar DB al arrancar
-init_db()
+# Inicializar DB al arrancar el servidor y no al importar el módulo:
+# los procesos del pool lo importan para ejecutar sus tareas
+@app.on_event("startup")
+def iniciar_db():
+    init_db()
 
 
 def parse_note_attributes(note_attrs: str) -> dict:
@@ -217,6 +436,196 @@ def parse_shopify_csv(content: str) -> list:
     return list(orders.values())
 
 
+def hash_linea(item: dict) -> str:
+    """Hash del contenido de una línea de pedido."""
+    contenido = [item['producto'], int(item['cantidad']), float(item['precio'] or 0), item['sku'] or '']
+    return hashlib.sha1(json.dumps(contenido, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def hash_pedido(order: dict) -> str:
+    """Hash del contenido de un pedido (datos de cliente, entrega y líneas)."""
+    contenido = [
+        order['email'] or '',
+        order['comuna'] or '',
+        order['fecha_entrega'] or '',
+        order['direccion'] or '',
+        order['telefono'] or '',
+        order['nombre_cliente'] or '',
+        float(order['total'] or 0),
+        sorted(hash_linea(item) for item in order['items'])
+    ]
+    return hashlib.sha1(json.dumps(contenido, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def _lineas_existentes(cursor, pedido_ids: list) -> dict:
+    """Obtiene las líneas actuales de varios pedidos, agrupadas por pedido_id."""
+    lineas = {pedido_id: [] for pedido_id in pedido_ids}
+    for lote in en_lotes(pedido_ids):
+        placeholders = ','.join('?' * len(lote))
+        cursor.execute(f'''
+            SELECT id, pedido_id, producto, cantidad, precio, sku, content_hash
+            FROM lineas_pedido
+            WHERE pedido_id IN ({placeholders})
+            ORDER BY id
+        ''', lote)
+        for row in cursor.fetchall():
+            lineas[row['pedido_id']].append(dict(row))
+    return lineas
+
+
+def importar_pedidos(cursor, orders: list, incremental: bool = False) -> dict:
+    """
+    Inserta los pedidos parseados en la base de datos.
+    
+    En modo normal los pedidos que ya existen se ignoran (duplicados).
+    En modo incremental se comparan los hashes de contenido y solo se
+    actualizan los pedidos que cambiaron, diffeando sus líneas.
+    """
+    stats = {'nuevos': 0, 'actualizados': 0, 'sin_cambios': 0, 'duplicados': 0, 'sin_fecha': 0}
+    
+    # Buscar en bloque los pedidos que ya existen
+    existentes = {}
+    order_numbers = [order['order_number'] for order in orders]
+    for lote in en_lotes(order_numbers):
+        placeholders = ','.join('?' * len(lote))
+        cursor.execute(f'''
+            SELECT id, order_number, email, comuna, fecha_original AS fecha_entrega,
+                   direccion, telefono, nombre_cliente, total, content_hash
+            FROM pedidos
+            WHERE order_number IN ({placeholders})
+        ''', lote)
+        for row in cursor.fetchall():
+            existentes[row['order_number']] = dict(row)
+    
+    # Pedidos importados antes de guardar hashes: calcularlo desde la DB
+    if incremental:
+        sin_hash = [p for p in existentes.values() if not p['content_hash']]
+        if sin_hash:
+            lineas = _lineas_existentes(cursor, [p['id'] for p in sin_hash])
+            for pedido in sin_hash:
+                pedido['items'] = lineas[pedido['id']]
+                pedido['content_hash'] = hash_pedido(pedido)
+            cursor.executemany(
+                "UPDATE pedidos SET content_hash = ? WHERE id = ?",
+                [(p['content_hash'], p['id']) for p in sin_hash]
+            )
+    
+    cambiados = []
+    nuevos_ids = []
+    
+    for order in orders:
+        existing = existentes.get(order['order_number'])
+        
+        if existing and not incremental:
+            stats['duplicados'] += 1
+            continue
+        
+        if not order['fecha_entrega']:
+            stats['sin_fecha'] += 1
+            continue
+        
+        content_hash = hash_pedido(order)
+        
+        if existing:
+            if existing['content_hash'] == content_hash:
+                stats['sin_cambios'] += 1
+            else:
+                cambiados.append((existing['id'], order, content_hash))
+            continue
+        
+        cursor.execute('''
+            INSERT INTO pedidos (order_number, email, comuna, fecha_entrega, fecha_original, direccion, telefono, nombre_cliente, total, created_at, content_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            order['order_number'],
+            order['email'],
+            order['comuna'],
+            order['fecha_entrega'],
+            order['fecha_entrega'],
+            order['direccion'],
+            order['telefono'],
+            order['nombre_cliente'],
+            order['total'],
+            order['created_at'],
+            content_hash
+        ))
+        
+        pedido_id = cursor.lastrowid
+        nuevos_ids.append(pedido_id)
+        
+        cursor.executemany('''
+            INSERT INTO lineas_pedido (pedido_id, producto, cantidad, precio, sku, content_hash)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [
+            (pedido_id, item['producto'], item['cantidad'], item['precio'], item['sku'], hash_linea(item))
+            for item in order['items']
+        ])
+        
+        stats['nuevos'] += 1
+    
+    cambiados_ids = [pedido_id for pedido_id, _, _ in cambiados]
+    if cambiados:
+        acumular_demanda(cursor, cambiados_ids, -1)
+        acumular_productos(cursor, cambiados_ids, -1)
+        _actualizar_pedidos(cursor, cambiados)
+        stats['actualizados'] = len(cambiados)
+    
+    acumular_demanda(cursor, nuevos_ids + cambiados_ids)
+    acumular_productos(cursor, nuevos_ids + cambiados_ids)
+    indexar_busqueda(cursor, nuevos_ids + cambiados_ids)
+    
+    return stats
+
+
+def _actualizar_pedidos(cursor, cambiados: list):
+    """Actualiza pedidos modificados en Shopify, diffeando sus líneas por hash."""
+    # Los pedidos postergados conservan la fecha asignada por el operador
+    cursor.executemany('''
+        UPDATE pedidos
+        SET email = ?, comuna = ?, fecha_original = ?,
+            fecha_entrega = CASE WHEN status = 'postergado' THEN fecha_entrega ELSE ? END,
+            direccion = ?, telefono = ?, nombre_cliente = ?, total = ?, content_hash = ?
+        WHERE id = ?
+    ''', [
+        (order['email'], order['comuna'], order['fecha_entrega'], order['fecha_entrega'],
+         order['direccion'], order['telefono'], order['nombre_cliente'], order['total'],
+         content_hash, pedido_id)
+        for pedido_id, order, content_hash in cambiados
+    ])
+    
+    lineas = _lineas_existentes(cursor, [pedido_id for pedido_id, _, _ in cambiados])
+    
+    borrar = []
+    insertar = []
+    completar_hash = []
+    
+    for pedido_id, order, _ in cambiados:
+        # Líneas actuales indexadas por hash (puede haber líneas repetidas)
+        actuales = {}
+        for linea in lineas[pedido_id]:
+            h = linea['content_hash'] or hash_linea(linea)
+            if not linea['content_hash']:
+                completar_hash.append((h, linea['id']))
+            actuales.setdefault(h, []).append(linea['id'])
+        
+        for item in order['items']:
+            h = hash_linea(item)
+            if actuales.get(h):
+                actuales[h].pop()
+            else:
+                insertar.append((pedido_id, item['producto'], item['cantidad'], item['precio'], item['sku'], h))
+        
+        for ids in actuales.values():
+            borrar.extend((linea_id,) for linea_id in ids)
+    
+    cursor.executemany("DELETE FROM lineas_pedido WHERE id = ?", borrar)
+    cursor.executemany("UPDATE lineas_pedido SET content_hash = ? WHERE id = ?", completar_hash)
+    cursor.executemany('''
+        INSERT INTO lineas_pedido (pedido_id, producto, cantidad, precio, sku, content_hash)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', insertar)
+
+
 def get_config(clave: str) -> str:
     conn = get_db()
     cursor = conn.cursor()
@@ -234,6 +643,128 @@ def set_config(clave: str, valor: str):
     conn.close()
 
 
+def get_data_version() -> int:
+    """Versión de los datos: aumenta con cada cambio en pedidos o categorías."""
+    return int(get_config('data_version') or 0)
+
+
+def incrementar_version(cursor) -> int:
+    """Incrementa la versión de los datos dentro de la transacción en curso."""
+    cursor.execute("UPDATE configuracion SET valor = CAST(valor AS INTEGER) + 1 WHERE clave = 'data_version'")
+    cursor.execute("SELECT valor FROM configuracion WHERE clave = 'data_version'")
+    return int(cursor.fetchone()[0])
+
+
+# ============================================
+# EXPORTACIÓN CSV / JSONL
+# ============================================
+
+SQL_LISTA_COMPRAS = '''
+    SELECT 
+        lp.producto,
+        SUM(lp.cantidad) as cantidad_total,
+        COALESCE(c.nombre, 'Sin Categoría') as categoria,
+        COALESCE(c.orden, 999) as categoria_orden
+    FROM lineas_pedido lp
+    JOIN pedidos p ON lp.pedido_id = p.id
+    LEFT JOIN producto_categoria pc ON lp.producto = pc.producto
+    LEFT JOIN categorias c ON pc.categoria_id = c.id
+    WHERE p.fecha_entrega = ? AND p.status IN ('pendiente', 'postergado')
+    GROUP BY lp.producto
+    ORDER BY categoria_orden, c.nombre, lp.producto
+'''
+
+# Una fila por línea de pedido, mismo filtro y orden que get_pedidos(fecha, status='activo')
+SQL_PEDIDOS_ARMADO = '''
+    SELECT p.order_number, p.status, p.nombre_cliente, p.comuna, p.direccion, p.telefono, p.email,
+           lp.producto, lp.cantidad, lp.sku
+    FROM pedidos p
+    LEFT JOIN lineas_pedido lp ON lp.pedido_id = p.id
+    WHERE p.fecha_entrega = ? AND p.status IN ('pendiente', 'postergado')
+    ORDER BY p.fecha_entrega, p.order_number, lp.id
+'''
+
+FORMATOS_EXPORTACION = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+    'csv.gz': 'application/gzip',
+    'jsonl.gz': 'application/gzip',
+}
+
+
+def _stream_exportacion(consultas: list, formato: str):
+    """
+    Genera el archivo exportado por partes leyendo el cursor de SQLite en
+    bloques, sin cargar todas las filas en memoria.
+    
+    consultas: lista de (sql, params, campos_extra). En JSONL los campos
+    extra se agregan a cada fila (p.ej. la tabla de origen en el backup).
+    """
+    es_csv = formato.startswith('csv')
+    compresor = zlib.compressobj(wbits=31) if formato.endswith('.gz') else None
+    
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if es_csv:
+        buffer.write('\ufeff')  # BOM para que Excel reconozca UTF-8
+    
+    # El generador se consume desde el threadpool, posiblemente en distintos hilos
+    conn = get_db(check_same_thread=False)
+    try:
+        encabezado = False
+        for sql, params, extra in consultas:
+            cursor = conn.execute(sql, params)
+            columnas = [d[0] for d in cursor.description]
+            if es_csv and not encabezado:
+                writer.writerow(columnas)
+                encabezado = True
+            
+            while True:
+                filas = cursor.fetchmany(500)
+                if not filas:
+                    break
+                for fila in filas:
+                    if es_csv:
+                        writer.writerow(fila)
+                    else:
+                        registro = dict(extra)
+                        registro.update(zip(columnas, fila))
+                        buffer.write(json.dumps(registro, ensure_ascii=False, default=str) + '\n')
+                
+                chunk = buffer.getvalue().encode('utf-8')
+                buffer.seek(0)
+                buffer.truncate()
+                if compresor:
+                    chunk = compresor.compress(chunk)
+                if chunk:
+                    yield chunk
+        
+        chunk = buffer.getvalue().encode('utf-8')
+        if compresor:
+            chunk = compresor.compress(chunk) + compresor.flush()
+        if chunk:
+            yield chunk
+    finally:
+        conn.close()
+
+
+def respuesta_exportacion(consultas: list, formato: str, nombre: str) -> StreamingResponse:
+    """Respuesta en streaming para descargas en formato csv/jsonl (opcionalmente .gz)."""
+    filename = f"{nombre}.{formato}"
+    return StreamingResponse(
+        _stream_exportacion(consultas, formato),
+        media_type=FORMATOS_EXPORTACION[formato],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+def validar_formato(formato: str, permitidos: tuple = ('xlsx',) + tuple(FORMATOS_EXPORTACION)) -> str:
+    formato = formato.lower()
+    if formato not in permitidos:
+        raise HTTPException(400, f"Formato no soportado: {formato}. Opciones: {', '.join(permitidos)}")
+    return formato
+
+
 # ============================================
 # RUTAS PRINCIPALES
 # ============================================
@@ -241,6 +772,9 @@ def set_config(clave: str, valor: str):
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
     """Página principal."""
+    # Antes que los datos: si cambian entremedio, el navegador recarga de más y no de menos
+    data_version = get_data_version()
+    
     conn = get_db()
     cursor = conn.cursor()
     
@@ -258,9 +792,9 @@ async def home(request: Request):
     pedidos_hoy = cursor.fetchone()[0]
     
     cursor.execute('''
-        SELECT COUNT(DISTINCT lp.producto) 
-        FROM lineas_pedido lp
-        LEFT JOIN producto_categoria pc ON lp.producto = pc.producto
+        SELECT COUNT(*)
+        FROM productos p
+        LEFT JOIN producto_categoria pc ON p.producto = pc.producto
         WHERE pc.id IS NULL
     ''')
     sin_categoria = cursor.fetchone()[0]
@@ -274,13 +808,46 @@ async def home(request: Request):
         "fechas_pendientes": fechas_pendientes,
         "pedidos_hoy": pedidos_hoy,
         "sin_categoria": sin_categoria,
-        "fecha_hoy": hoy
+        "fecha_hoy": hoy,
+        "data_version": data_version
     })
 
 
+def _guardar_importacion(orders: list, incremental: bool, background_tasks: BackgroundTasks) -> dict:
+    """Importa los pedidos en una sola transacción y avisa a los clientes conectados."""
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    stats = importar_pedidos(cursor, orders, incremental=incremental)
+    
+    version = None
+    if stats['nuevos'] or stats['actualizados']:
+        version = incrementar_version(cursor)
+    
+    conn.commit()
+    conn.close()
+    
+    if version:
+        publicar_evento({
+            'tipo': 'importacion',
+            'nuevos': stats['nuevos'],
+            'actualizados': stats['actualizados'],
+            'version': version
+        })
+        # Dejar listas las descargas de los próximos días
+        background_tasks.add_task(precalcular_proximas_fechas)
+    
+    return stats
+
+
 @app.post("/upload")
-async def upload_csv(file: UploadFile = File(...)):
-    """Sube y procesa un CSV de Shopify."""
+async def upload_csv(background_tasks: BackgroundTasks, file: UploadFile = File(...), incremental: bool = Form(False)):
+    """
+    Sube y procesa un CSV de Shopify.
+    
+    Con incremental=True los pedidos ya importados que cambiaron en Shopify
+    se actualizan en vez de ignorarse.
+    """
     if not file.filename.endswith('.csv'):
         raise HTTPException(400, "El archivo debe ser CSV")
     
@@ -289,60 +856,140 @@ async def upload_csv(file: UploadFile = File(...)):
     
     orders = parse_shopify_csv(content)
     
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    nuevos = 0
-    duplicados = 0
-    sin_fecha = 0
+    stats = _guardar_importacion(orders, incremental, background_tasks)
     
-    for order in orders:
-        cursor.execute("SELECT id FROM pedidos WHERE order_number = ?", (order['order_number'],))
-        existing = cursor.fetchone()
-        
-        if existing:
+    return {
+        "success": True,
+        **stats,
+        "total": len(orders)
+    }
+
+
+# Pool de procesos para parsear CSVs y generar Excel en paralelo (se crea al arrancar;
+# sin él, p.ej. fuera del servidor, las tareas corren en el pool de hilos del loop)
+_pool_procesos = None
+# Workers por defecto: pocos, es un servidor chico que comparte la máquina
+MAX_WORKERS_POR_DEFECTO = 4
+
+
+def _workers_por_defecto() -> int:
+    """CPUs disponibles para este proceso (no las de toda la máquina), con tope."""
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    return min(MAX_WORKERS_POR_DEFECTO, cpus)
+
+
+@app.on_event("startup")
+def iniciar_pool_procesos():
+    # spawn y no fork: hacer fork de un servidor con hilos puede colgar al hijo
+    global _pool_procesos
+    _pool_procesos = ProcessPoolExecutor(
+        max_workers=int(os.environ.get('VEGA_WORKERS', 0)) or _workers_por_defecto(),
+        mp_context=multiprocessing.get_context('spawn')
+    )
+
+
+@app.on_event("shutdown")
+def cerrar_pool_procesos():
+    global _pool_procesos
+    if _pool_procesos is not None:
+        _pool_procesos.shutdown(cancel_futures=True)
+        _pool_procesos = None
+
+
+def parsear_archivo_csv(content: bytes) -> list:
+    """Decodifica y parsea un CSV de Shopify (se ejecuta en un proceso del pool)."""
+    return parse_shopify_csv(content.decode('utf-8-sig'))
+
+
+def es_continuacion(order: dict) -> bool:
+    """
+    Fragmento de pedido sin los datos del pedido (Email, Total, Note Attributes):
+    Shopify solo los escribe en la primera fila de cada pedido.
+    """
+    return not (order['email'] or order['total'] or order['comuna'] or order['fecha_entrega'])
+
+
+def fusionar_pedidos(partes: list) -> tuple:
+    """
+    Junta los pedidos de varios archivos por order_number, en cualquier orden de archivos.
+    Un pedido cortado entre dos archivos continúa en otro sin los datos del
+    pedido: ese fragmento se agrega a la copia que tiene los datos, venga antes
+    o después. Dos copias con datos (exportaciones que se solapan o el mismo
+    archivo dos veces) son un duplicado y se conserva la primera; un fragmento
+    igual a uno ya agregado también.
+    Devuelve (pedidos, cantidad de pedidos divididos, cantidad de duplicados).
+    """
+    pedidos = {}
+    fragmentos = []
+    divididos = duplicados = 0
+    for orders in partes:
+        for order in orders:
+            if es_continuacion(order):
+                fragmentos.append(order)
+            elif order['order_number'] in pedidos:
+                duplicados += 1
+            else:
+                pedidos[order['order_number']] = order
+    
+    # Los fragmentos se agregan al final, cuando ya se vieron todas las copias con datos
+    agregados = {}
+    for order in fragmentos:
+        numero = order['order_number']
+        if numero not in pedidos:
+            # Falta el archivo con los datos del pedido: se importa lo que hay
+            pedidos[numero] = order
+            agregados[numero] = [order['items']]
+        elif order['items'] in agregados.setdefault(numero, []):
             duplicados += 1
-            continue
-        
-        if not order['fecha_entrega']:
-            sin_fecha += 1
-            continue
-        
-        cursor.execute('''
-            INSERT INTO pedidos (order_number, email, comuna, fecha_entrega, fecha_original, direccion, telefono, nombre_cliente, total, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            order['order_number'],
-            order['email'],
-            order['comuna'],
-            order['fecha_entrega'],
-            order['fecha_entrega'],
-            order['direccion'],
-            order['telefono'],
-            order['nombre_cliente'],
-            order['total'],
-            order['created_at']
-        ))
-        
-        pedido_id = cursor.lastrowid
-        
-        for item in order['items']:
-            cursor.execute('''
-                INSERT INTO lineas_pedido (pedido_id, producto, cantidad, precio, sku)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (pedido_id, item['producto'], item['cantidad'], item['precio'], item['sku']))
-        
-        nuevos += 1
+        else:
+            pedidos[numero]['items'].extend(order['items'])
+            agregados[numero].append(order['items'])
+            divididos += 1
+    return list(pedidos.values()), divididos, duplicados
+
+
+@app.post("/upload-multiple")
+async def upload_csv_multiple(
+    background_tasks: BackgroundTasks,
+    files: List[UploadFile] = File(...),
+    incremental: bool = Form(False)
+):
+    """
+    Sube varios CSV de Shopify (exportaciones divididas en partes).
+    Cada archivo se parsea en paralelo en el pool de procesos y todo
+    se importa en una sola transacción.
+    """
+    for file in files:
+        if not file.filename.endswith('.csv'):
+            raise HTTPException(400, f"{file.filename}: el archivo debe ser CSV")
+    
+    contenidos = [await file.read() for file in files]
+    
+    loop = asyncio.get_running_loop()
+    try:
+        partes = await asyncio.gather(*[
+            loop.run_in_executor(_pool_procesos, parsear_archivo_csv, content) for content in contenidos
+        ])
+    except UnicodeDecodeError:
+        raise HTTPException(400, "Los archivos deben estar en UTF-8")
     
-    conn.commit()
-    conn.close()
+    orders, divididos, duplicados = fusionar_pedidos(partes)
+    
+    stats = _guardar_importacion(orders, incremental, background_tasks)
+    stats['duplicados'] += duplicados
     
     return {
         "success": True,
-        "nuevos": nuevos,
-        "duplicados": duplicados,
-        "sin_fecha": sin_fecha,
-        "total": len(orders)
+        **stats,
+        "total": len(orders),
+        "divididos": divididos,
+        "archivos": [
+            {"nombre": file.filename, "pedidos": len(parte)}
+            for file, parte in zip(files, partes)
+        ]
     }
 
 
@@ -364,8 +1011,11 @@ async def create_categoria(nombre: str = Form(...)):
         cursor.execute("SELECT MAX(orden) FROM categorias")
         max_orden = cursor.fetchone()[0] or 0
         cursor.execute("INSERT INTO categorias (nombre, orden) VALUES (?, ?)", (nombre, max_orden + 1))
+        categoria_id = cursor.lastrowid
+        version = incrementar_version(cursor)
         conn.commit()
-        return {"success": True, "id": cursor.lastrowid}
+        publicar_evento({'tipo': 'categorias', 'version': version})
+        return {"success": True, "id": categoria_id}
     except sqlite3.IntegrityError:
         raise HTTPException(400, "La categoría ya existe")
     finally:
@@ -377,11 +1027,11 @@ async def get_productos_sin_categoria():
     conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
-        SELECT DISTINCT lp.producto
-        FROM lineas_pedido lp
-        LEFT JOIN producto_categoria pc ON lp.producto = pc.producto
+        SELECT p.producto
+        FROM productos p
+        LEFT JOIN producto_categoria pc ON p.producto = pc.producto
         WHERE pc.id IS NULL
-        ORDER BY lp.producto
+        ORDER BY p.producto
     ''')
     productos = [row[0] for row in cursor.fetchall()]
     conn.close()
@@ -393,13 +1043,15 @@ async def asignar_categoria(producto: str = Form(...), categoria_id: int = Form(
     conn = get_db()
     cursor = conn.cursor()
     cursor.execute('INSERT OR REPLACE INTO producto_categoria (producto, categoria_id) VALUES (?, ?)', (producto, categoria_id))
+    version = incrementar_version(cursor)
     conn.commit()
     conn.close()
+    publicar_evento({'tipo': 'categorias', 'version': version})
     return {"success": True}
 
 
-@app.get("/api/pedidos")
-async def get_pedidos(fecha: Optional[str] = None, status: Optional[str] = None):
+def consultar_pedidos(fecha: Optional[str] = None, status: Optional[str] = None) -> list:
+    """Pedidos (con sus líneas) filtrados por fecha de entrega y status."""
     conn = get_db()
     cursor = conn.cursor()
     
@@ -430,6 +1082,66 @@ async def get_pedidos(fecha: Optional[str] = None, status: Optional[str] = None)
     return pedidos
 
 
+@app.get("/api/pedidos")
+async def get_pedidos(fecha: Optional[str] = None, status: Optional[str] = None):
+    return consultar_pedidos(fecha, status)
+
+
+@app.get("/api/buscar")
+async def buscar(q: str, status: Optional[str] = None, limit: int = 20, offset: int = 0):
+    """
+    Búsqueda de texto completo sobre pedidos (cliente, email, teléfono,
+    dirección, comuna, número de pedido y productos), ordenada por relevancia.
+    """
+    # Cada palabra se busca como prefijo; todas deben coincidir
+    palabras = re.findall(r'\w+', q)
+    limit = max(1, min(limit, 100))
+    offset = max(0, offset)
+    
+    if not palabras:
+        return {"q": q, "total": 0, "limit": limit, "offset": offset, "resultados": []}
+    
+    match = ' '.join(f'"{palabra}"*' for palabra in palabras)
+    
+    where = "WHERE pedidos_fts MATCH ?"
+    params = [match]
+    
+    if status:
+        if status == 'activo':
+            where += " AND p.status IN ('pendiente', 'postergado')"
+        else:
+            where += " AND p.status = ?"
+            params.append(status)
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    cursor.execute(f'''
+        SELECT COUNT(*)
+        FROM pedidos_fts
+        JOIN pedidos p ON p.id = pedidos_fts.rowid
+        {where}
+    ''', params)
+    total = cursor.fetchone()[0]
+    
+    # Pesos bm25 por columna: order_number, nombre_cliente, email, telefono, direccion, comuna, productos
+    cursor.execute(f'''
+        SELECT p.id, p.order_number, p.nombre_cliente, p.email, p.telefono, p.direccion, p.comuna,
+               p.fecha_entrega, p.status, p.total,
+               snippet(pedidos_fts, -1, '[', ']', '…', 10) AS coincidencia
+        FROM pedidos_fts
+        JOIN pedidos p ON p.id = pedidos_fts.rowid
+        {where}
+        ORDER BY bm25(pedidos_fts, 10.0, 5.0, 4.0, 4.0, 2.0, 1.0, 1.0), p.fecha_entrega DESC
+        LIMIT ? OFFSET ?
+    ''', params + [limit, offset])
+    resultados = [dict(row) for row in cursor.fetchall()]
+    
+    conn.close()
+    
+    return {"q": q, "total": total, "limit": limit, "offset": offset, "resultados": resultados}
+
+
 @app.get("/api/fechas-pendientes")
 async def get_fechas_pendientes():
     conn = get_db()
@@ -447,25 +1159,12 @@ async def get_fechas_pendientes():
     return fechas
 
 
-@app.get("/api/lista-compras/{fecha}")
-async def get_lista_compras(fecha: str):
+def calcular_lista_compras(fecha: str) -> dict:
+    """Productos a comprar para una fecha, agrupados por categoría."""
     conn = get_db()
     cursor = conn.cursor()
     
-    cursor.execute('''
-        SELECT 
-            lp.producto,
-            SUM(lp.cantidad) as cantidad_total,
-            COALESCE(c.nombre, 'Sin Categoría') as categoria,
-            COALESCE(c.orden, 999) as categoria_orden
-        FROM lineas_pedido lp
-        JOIN pedidos p ON lp.pedido_id = p.id
-        LEFT JOIN producto_categoria pc ON lp.producto = pc.producto
-        LEFT JOIN categorias c ON pc.categoria_id = c.id
-        WHERE p.fecha_entrega = ? AND p.status IN ('pendiente', 'postergado')
-        GROUP BY lp.producto
-        ORDER BY categoria_orden, c.nombre, lp.producto
-    ''', (fecha,))
+    cursor.execute(SQL_LISTA_COMPRAS, (fecha,))
     
     items = [dict(row) for row in cursor.fetchall()]
     conn.close()
@@ -483,10 +1182,15 @@ async def get_lista_compras(fecha: str):
     return por_categoria
 
 
-@app.get("/descargar/lista-compras/{fecha}")
-async def descargar_lista_compras(fecha: str):
-    lista = await get_lista_compras(fecha)
-    
+@app.get("/api/lista-compras/{fecha}")
+async def get_lista_compras(fecha: str):
+    lista = cache_obtener('lista_compras', fecha)
+    if lista is None:
+        lista = calcular_lista_compras(fecha)
+    return lista
+
+
+def generar_lista_compras_excel(fecha: str, lista: dict, filepath: Path) -> Path:
     wb = Workbook()
     ws = wb.active
     ws.title = "Lista de Compras"
@@ -551,21 +1255,30 @@ async def descargar_lista_compras(fecha: str):
     ws.column_dimensions['B'].width = 12
     ws.column_dimensions['C'].width = 8
     
-    filename = f"lista_compras_{fecha}.xlsx"
-    filepath = OUTPUT_DIR / filename
     wb.save(filepath)
     
-    return FileResponse(filepath, filename=filename, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    return filepath
 
 
-@app.get("/descargar/pedidos-armado/{fecha}")
-async def descargar_pedidos_armado(fecha: str):
-    pedidos = await get_pedidos(fecha=fecha, status='activo')
+@app.get("/descargar/lista-compras/{fecha}")
+async def descargar_lista_compras(fecha: str, formato: str = 'xlsx'):
+    formato = validar_formato(formato)
+    if formato != 'xlsx':
+        consulta = f"SELECT categoria, producto, cantidad_total AS cantidad FROM ({SQL_LISTA_COMPRAS})"
+        return respuesta_exportacion([(consulta, (fecha,), {})], formato, f"lista_compras_{fecha}")
     
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Pedidos Armado"
+    filename = f"lista_compras_{fecha}.xlsx"
+    
+    filepath = cache_obtener('lista_compras_xlsx', fecha)
+    if filepath is None:
+        lista = await get_lista_compras(fecha)
+        filepath = generar_lista_compras_excel(fecha, lista, OUTPUT_DIR / filename)
     
+    return FileResponse(filepath, filename=filename, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+
+def escribir_hoja_armado(ws, titulo: str, pedidos: list):
+    """Escribe en la hoja los pedidos a armar, uno bajo otro con sus productos."""
     header_fill = PatternFill(start_color="2E5C46", end_color="2E5C46", fill_type="solid")
     header_font = Font(bold=True, color="FFFFFF", size=11)
     order_fill = PatternFill(start_color="E8F5E9", end_color="E8F5E9", fill_type="solid")
@@ -580,7 +1293,7 @@ async def descargar_pedidos_armado(fecha: str):
     
     # Título
     ws.merge_cells('A1:D1')
-    ws['A1'] = f"📦 Pedidos para Armar - {fecha}"
+    ws['A1'] = titulo
     ws['A1'].font = Font(bold=True, size=16, color="2E5C46")
     ws['A1'].alignment = Alignment(horizontal='center', vertical='center')
     ws.row_dimensions[1].height = 30
@@ -632,26 +1345,201 @@ async def descargar_pedidos_armado(fecha: str):
     ws.column_dimensions['A'].width = 45
     ws.column_dimensions['B'].width = 10
     ws.column_dimensions['C'].width = 8
+
+
+def generar_pedidos_armado_excel(fecha: str, pedidos: list, filepath: Path) -> Path:
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Pedidos Armado"
+    escribir_hoja_armado(ws, f"📦 Pedidos para Armar - {fecha}", pedidos)
+    wb.save(filepath)
     
-    filename = f"pedidos_armado_{fecha}.xlsx"
-    filepath = OUTPUT_DIR / filename
+    return filepath
+
+
+def particionar_por_comuna(pedidos: list) -> dict:
+    """Agrupa los pedidos por comuna, cada grupo ordenado por dirección."""
+    comunas = {}
+    for pedido in pedidos:
+        comunas.setdefault(pedido['comuna'] or 'Sin comuna', []).append(pedido)
+    return {
+        comuna: sorted(grupo, key=lambda p: ((p['direccion'] or '').casefold(), p['order_number']))
+        for comuna, grupo in sorted(comunas.items(), key=lambda c: c[0].casefold())
+    }
+
+
+def _titulo_hoja(nombre: str, usados: set) -> str:
+    """Nombre válido y único para una hoja de Excel (máx. 31 caracteres, sin []:*?/\\)."""
+    base = re.sub(r'[\[\]:*?/\\]', '-', nombre)[:31] or 'Hoja'
+    titulo, n = base, 2
+    while titulo.casefold() in usados:
+        sufijo = f" ({n})"
+        titulo, n = base[:31 - len(sufijo)] + sufijo, n + 1
+    usados.add(titulo.casefold())
+    return titulo
+
+
+def generar_armado_comuna(fecha: str, comuna: str, pedidos: list, filepath: Path) -> Path:
+    """Libro de armado de una sola comuna (se ejecuta en un proceso del pool)."""
+    wb = Workbook()
+    ws = wb.active
+    ws.title = _titulo_hoja(comuna, set())
+    escribir_hoja_armado(ws, f"📦 {comuna} - {fecha}", pedidos)
     wb.save(filepath)
+    return filepath
+
+
+def generar_armado_por_comuna_hojas(fecha: str, pedidos: list, filepath: Path) -> Path:
+    """Un solo libro con una hoja por comuna."""
+    wb = Workbook()
+    wb.remove(wb.active)
+    usados = set()
+    for comuna, grupo in particionar_por_comuna(pedidos).items():
+        escribir_hoja_armado(wb.create_sheet(_titulo_hoja(comuna, usados)), f"📦 {comuna} - {fecha}", grupo)
+    if not wb.worksheets:
+        escribir_hoja_armado(wb.create_sheet("Pedidos Armado"), f"📦 Pedidos para Armar - {fecha}", [])
+    wb.save(filepath)
+    return filepath
+
+
+async def generar_armado_por_comuna_zip(fecha: str, pedidos: list, filepath: Path) -> Path:
+    """Zip con un libro por comuna; los libros se generan en paralelo en el pool de procesos."""
+    loop = asyncio.get_running_loop()
+    with tempfile.TemporaryDirectory(dir=OUTPUT_DIR) as tmp:
+        tareas = []
+        usados = set()
+        for comuna, grupo in particionar_por_comuna(pedidos).items():
+            slug = _titulo_hoja(re.sub(r'[^\w-]+', '_', comuna).strip('_') or 'comuna', usados)
+            nombre = f"pedidos_armado_{fecha}_{slug}.xlsx"
+            tareas.append(loop.run_in_executor(_pool_procesos, generar_armado_comuna, fecha, comuna, grupo, Path(tmp) / nombre))
+        archivos = await asyncio.gather(*tareas)
+        
+        # Los xlsx ya vienen comprimidos
+        with zipfile.ZipFile(filepath, 'w', zipfile.ZIP_STORED) as zf:
+            for archivo in archivos:
+                zf.write(archivo, archivo.name)
+    return filepath
+
+
+@app.get("/descargar/pedidos-armado/{fecha}")
+async def descargar_pedidos_armado(fecha: str, formato: str = 'xlsx', particion: Optional[str] = None, salida: str = 'hojas'):
+    """
+    Hoja de armado del día. Con particion=comuna los pedidos se separan por
+    comuna, ordenados por dirección: salida=hojas da un libro con una hoja
+    por comuna y salida=zip un zip con un libro por comuna.
+    """
+    formato = validar_formato(formato)
+    if particion is not None:
+        if particion != 'comuna':
+            raise HTTPException(400, "particion debe ser 'comuna'")
+        if formato != 'xlsx':
+            raise HTTPException(400, "La partición por comuna solo está disponible en xlsx")
+        if salida not in ('hojas', 'zip'):
+            raise HTTPException(400, "salida debe ser 'hojas' o 'zip'")
+        
+        pedidos = consultar_pedidos(fecha=fecha, status='activo')
+        if salida == 'zip':
+            filename = f"pedidos_armado_{fecha}_comunas.zip"
+            filepath = await generar_armado_por_comuna_zip(fecha, pedidos, OUTPUT_DIR / filename)
+            return FileResponse(filepath, filename=filename, media_type="application/zip")
+        
+        filename = f"pedidos_armado_{fecha}_comunas.xlsx"
+        filepath = generar_armado_por_comuna_hojas(fecha, pedidos, OUTPUT_DIR / filename)
+        return FileResponse(filepath, filename=filename, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    
+    if formato != 'xlsx':
+        return respuesta_exportacion([(SQL_PEDIDOS_ARMADO, (fecha,), {})], formato, f"pedidos_armado_{fecha}")
+    
+    filename = f"pedidos_armado_{fecha}.xlsx"
+    
+    filepath = cache_obtener('pedidos_armado_xlsx', fecha)
+    if filepath is None:
+        pedidos = consultar_pedidos(fecha=fecha, status='activo')
+        filepath = generar_pedidos_armado_excel(fecha, pedidos, OUTPUT_DIR / filename)
     
     return FileResponse(filepath, filename=filename, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
 
+# Acciones de estado, aplicadas con SQL por conjuntos sobre una lista de ids
+ACCIONES_PEDIDO = {
+    'completar': "UPDATE pedidos SET status = 'completado', completed_at = CURRENT_TIMESTAMP WHERE id IN ({})",
+    'reactivar': "UPDATE pedidos SET status = 'pendiente', completed_at = NULL WHERE id IN ({})",
+    'postergar': "UPDATE pedidos SET fecha_entrega = ?, status = 'postergado' WHERE id IN ({})",
+    'eliminar': None,
+}
+
+# Status del filtro por lote cuando no se indica: los pedidos ya completados
+# solo se completan, postergan o eliminan si se pide status explícitamente
+STATUS_LOTE_POR_DEFECTO = {
+    'completar': 'activo',
+    'postergar': 'activo',
+    'eliminar': 'activo',
+    'reactivar': 'completado',
+}
+
+
+def cambiar_estado_pedidos(cursor, accion: str, pedido_ids: list, nueva_fecha: Optional[str] = None) -> list:
+    """
+    Aplica una acción (completar, reactivar, postergar, eliminar) a varios
+    pedidos dentro de la transacción en curso.
+    Devuelve un evento por cada pedido afectado; los ids inexistentes se omiten.
+    """
+    anteriores = {}
+    for lote in en_lotes(list(pedido_ids)):
+        placeholders = ','.join('?' * len(lote))
+        cursor.execute(f"SELECT id, status, fecha_entrega FROM pedidos WHERE id IN ({placeholders})", lote)
+        for row in cursor.fetchall():
+            anteriores[row['id']] = dict(row)
+    
+    ids = list(anteriores)
+    if not ids:
+        return []
+    
+    # Postergar mueve la demanda de fecha; eliminar la descuenta junto con sus productos
+    if accion in ('postergar', 'eliminar'):
+        acumular_demanda(cursor, ids, -1)
+    if accion == 'eliminar':
+        acumular_productos(cursor, ids, -1)
+    
+    for lote in en_lotes(ids):
+        placeholders = ','.join('?' * len(lote))
+        if accion == 'eliminar':
+            cursor.execute(f"DELETE FROM lineas_pedido WHERE pedido_id IN ({placeholders})", lote)
+            cursor.execute(f"DELETE FROM pedidos WHERE id IN ({placeholders})", lote)
+        elif accion == 'postergar':
+            cursor.execute(ACCIONES_PEDIDO[accion].format(placeholders), [nueva_fecha] + lote)
+        else:
+            cursor.execute(ACCIONES_PEDIDO[accion].format(placeholders), lote)
+    
+    if accion == 'eliminar':
+        desindexar_busqueda(cursor, ids)
+    elif accion == 'postergar':
+        acumular_demanda(cursor, ids)
+    
+    version = incrementar_version(cursor)
+    
+    eventos = []
+    for pedido_id, anterior in anteriores.items():
+        if accion == 'eliminar':
+            status, fecha = None, None
+        elif accion == 'postergar':
+            status, fecha = 'postergado', nueva_fecha
+        else:
+            status = 'completado' if accion == 'completar' else 'pendiente'
+            fecha = anterior['fecha_entrega']
+        eventos.append(evento_pedido(pedido_id, accion, anterior, status, fecha, version))
+    return eventos
+
+
 @app.post("/api/pedidos/{pedido_id}/completar")
 async def completar_pedido(pedido_id: int):
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute("""
-        UPDATE pedidos 
-        SET status = 'completado', 
-            completed_at = CURRENT_TIMESTAMP 
-        WHERE id = ?
-    """, (pedido_id,))
+    eventos = cambiar_estado_pedidos(cursor, 'completar', [pedido_id])
     conn.commit()
     conn.close()
+    for evento in eventos:
+        publicar_evento(evento)
     return {"success": True}
 
 
@@ -660,14 +1548,11 @@ async def reactivar_pedido(pedido_id: int):
     """Deshace el completado de un pedido, volviéndolo a pendiente."""
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute("""
-        UPDATE pedidos 
-        SET status = 'pendiente', 
-            completed_at = NULL 
-        WHERE id = ?
-    """, (pedido_id,))
+    eventos = cambiar_estado_pedidos(cursor, 'reactivar', [pedido_id])
     conn.commit()
     conn.close()
+    for evento in eventos:
+        publicar_evento(evento)
     return {"success": True}
 
 
@@ -709,7 +1594,9 @@ async def auto_completar_pasados():
                 completed_at = CURRENT_TIMESTAMP 
             WHERE fecha_entrega < ? AND status = 'pendiente'
         """, (hoy,))
+        version = incrementar_version(cursor)
         conn.commit()
+        publicar_evento({'tipo': 'recarga', 'version': version})
     
     conn.close()
     return {"success": True, "completados": cantidad}
@@ -734,9 +1621,11 @@ async def get_pedidos_pasados_pendientes():
 async def postergar_pedido(pedido_id: int, nueva_fecha: str = Form(...)):
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute("UPDATE pedidos SET fecha_entrega = ?, status = 'postergado' WHERE id = ?", (nueva_fecha, pedido_id))
+    eventos = cambiar_estado_pedidos(cursor, 'postergar', [pedido_id], nueva_fecha)
     conn.commit()
     conn.close()
+    for evento in eventos:
+        publicar_evento(evento)
     return {"success": True}
 
 
@@ -744,17 +1633,211 @@ async def postergar_pedido(pedido_id: int, nueva_fecha: str = Form(...)):
 async def eliminar_pedido(pedido_id: int):
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute("DELETE FROM lineas_pedido WHERE pedido_id = ?", (pedido_id,))
-    cursor.execute("DELETE FROM pedidos WHERE id = ?", (pedido_id,))
+    eventos = cambiar_estado_pedidos(cursor, 'eliminar', [pedido_id])
     conn.commit()
     conn.close()
+    for evento in eventos:
+        publicar_evento(evento)
     return {"success": True}
 
 
+@app.post("/api/pedidos-lote/{accion}")
+async def accion_pedidos_lote(
+    accion: str,
+    ids: List[int] = Form([]),
+    fecha: Optional[str] = Form(None),
+    comuna: Optional[str] = Form(None),
+    status: Optional[str] = Form(None),
+    nueva_fecha: Optional[str] = Form(None)
+):
+    """
+    Completa, reactiva, posterga o elimina varios pedidos en una sola transacción.
+    Los pedidos se indican por ids o por un filtro (fecha + comuna + status).
+    Sin status, el filtro toma los pedidos activos (pendientes y postergados),
+    o los completados para reactivar.
+    """
+    if accion not in ACCIONES_PEDIDO:
+        raise HTTPException(400, f"Acción no válida: {accion}")
+    if accion == 'postergar' and not nueva_fecha:
+        raise HTTPException(400, "Debe indicar nueva_fecha para postergar")
+    if not ids and not fecha:
+        raise HTTPException(400, "Debe indicar ids o un filtro con fecha")
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    # Reservar la escritura desde ya: el filtro y el cambio ven los mismos datos
+    cursor.execute("BEGIN IMMEDIATE")
+    
+    if not ids:
+        query = "SELECT id FROM pedidos WHERE fecha_entrega = ?"
+        params = [fecha]
+        
+        if comuna:
+            query += " AND comuna = ?"
+            params.append(comuna)
+        
+        status = status or STATUS_LOTE_POR_DEFECTO[accion]
+        if status == 'activo':
+            query += " AND status IN ('pendiente', 'postergado')"
+        else:
+            query += " AND status = ?"
+            params.append(status)
+        
+        cursor.execute(query, params)
+        ids = [row[0] for row in cursor.fetchall()]
+    
+    eventos = cambiar_estado_pedidos(cursor, accion, ids, nueva_fecha)
+    
+    conn.commit()
+    conn.close()
+    
+    for evento in eventos:
+        publicar_evento(evento)
+    
+    afectados = {evento['pedido_id']: evento for evento in eventos}
+    resultados = []
+    for pedido_id in ids:
+        evento = afectados.get(pedido_id)
+        if evento:
+            resultados.append({
+                "id": pedido_id,
+                "resultado": "ok",
+                "status_anterior": evento['status_anterior'],
+                "status": evento['status'],
+                "fecha_entrega": evento['fecha_entrega']
+            })
+        else:
+            resultados.append({"id": pedido_id, "resultado": "no_encontrado"})
+    
+    return {
+        "success": True,
+        "accion": accion,
+        "afectados": len(eventos),
+        "version": eventos[0]['version'] if eventos else None,
+        "resultados": resultados
+    }
+
+
+# ============================================
+# EVENTOS EN VIVO (SSE)
+# ============================================
+
+# Colas de los navegadores conectados a /api/eventos (un proceso; ver Procfile)
+_suscriptores = set()
+
+# Marca de fin de stream, se encola al apagar el servidor
+_FIN_EVENTOS = {'tipo': 'fin'}
+
+
+def publicar_evento(evento: dict):
+    """Envía un evento a todos los navegadores conectados."""
+    for cola in list(_suscriptores):
+        try:
+            cola.put_nowait(evento)
+        except asyncio.QueueFull:
+            # Cliente demasiado lento: descartar lo pendiente y pedirle que recargue
+            while not cola.empty():
+                cola.get_nowait()
+            cola.put_nowait({'tipo': 'recarga', 'version': evento.get('version')})
+
+
+def cerrar_eventos():
+    """Termina todos los streams abiertos; los navegadores reconectan solos (retry)."""
+    for cola in list(_suscriptores):
+        while not cola.empty():
+            cola.get_nowait()
+        cola.put_nowait(_FIN_EVENTOS)
+
+
+@app.on_event("startup")
+async def cerrar_eventos_al_recibir_senal():
+    """
+    uvicorn espera a que terminen las conexiones abiertas antes del evento
+    shutdown, así que los streams SSE se cierran apenas llega la señal de apagado.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        anterior = signal.getsignal(sig)
+        
+        def manejador(signum, frame, anterior=anterior):
+            loop.call_soon_threadsafe(cerrar_eventos)
+            if callable(anterior):
+                anterior(signum, frame)
+        
+        signal.signal(sig, manejador)
+
+
+@app.on_event("shutdown")
+def cerrar_eventos_al_apagar():
+    cerrar_eventos()
+
+
+def evento_pedido(pedido_id: int, accion: str, anterior: dict, status: Optional[str], fecha_entrega: Optional[str], version: int) -> dict:
+    """Evento compacto de cambio de estado de un pedido."""
+    return {
+        'tipo': 'pedido',
+        'accion': accion,
+        'pedido_id': pedido_id,
+        'status': status,
+        'fecha_entrega': fecha_entrega,
+        'status_anterior': anterior['status'],
+        'fecha_anterior': anterior['fecha_entrega'],
+        'version': version
+    }
+
+
+@app.get("/api/eventos")
+async def eventos(request: Request):
+    """Stream SSE con los cambios de pedidos, para actualizar la UI sin recargar."""
+    cola = asyncio.Queue(maxsize=200)
+    _suscriptores.add(cola)
+    
+    async def stream():
+        try:
+            version = get_data_version()
+            yield f"retry: 3000\nevent: conectado\ndata: {json.dumps({'version': version})}\n\n"
+            # Reconexión: si hubo cambios mientras estaba desconectado, pedir recarga
+            ultimo = request.headers.get('last-event-id')
+            if ultimo and ultimo != str(version):
+                yield f"id: {version}\nevent: recarga\ndata: {json.dumps({'tipo': 'recarga', 'version': version})}\n\n"
+            while not await request.is_disconnected():
+                try:
+                    evento = await asyncio.wait_for(cola.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"  # Mantener viva la conexión a través de proxies
+                    continue
+                if evento is _FIN_EVENTOS:
+                    return
+                yield f"id: {evento['version']}\nevent: {evento['tipo']}\ndata: {json.dumps(evento)}\n\n"
+        finally:
+            _suscriptores.discard(cola)
+    
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+
 # ============================================
 # BACKUP
 # ============================================
 
+# Consultas del backup por tabla (compartidas por Excel y JSONL)
+BACKUP_CONSULTAS = {
+    'pedidos': """
+        SELECT id, order_number, email, comuna, fecha_entrega, fecha_original, direccion, telefono,
+               nombre_cliente, total, created_at, imported_at, status, completed_at
+        FROM pedidos
+    """,
+    'lineas_pedido': "SELECT id, pedido_id, producto, cantidad, precio, sku FROM lineas_pedido",
+    'categorias': "SELECT id, nombre, orden FROM categorias",
+    'producto_categoria': "SELECT id, producto, categoria_id FROM producto_categoria",
+}
+
+
 def generar_backup_excel() -> Path:
     conn = get_db()
     cursor = conn.cursor()
@@ -771,7 +1854,7 @@ def generar_backup_excel() -> Path:
     for col in range(1, len(headers) + 1):
         ws.cell(row=1, column=col).fill = header_fill
         ws.cell(row=1, column=col).font = header_font
-    cursor.execute("SELECT * FROM pedidos")
+    cursor.execute(BACKUP_CONSULTAS['pedidos'])
     for row in cursor.fetchall():
         ws.append(list(row))
     
@@ -781,7 +1864,7 @@ def generar_backup_excel() -> Path:
     for col in range(1, 7):
         ws2.cell(row=1, column=col).fill = header_fill
         ws2.cell(row=1, column=col).font = header_font
-    cursor.execute("SELECT * FROM lineas_pedido")
+    cursor.execute(BACKUP_CONSULTAS['lineas_pedido'])
     for row in cursor.fetchall():
         ws2.append(list(row))
     
@@ -791,7 +1874,7 @@ def generar_backup_excel() -> Path:
     for col in range(1, 4):
         ws3.cell(row=1, column=col).fill = header_fill
         ws3.cell(row=1, column=col).font = header_font
-    cursor.execute("SELECT * FROM categorias")
+    cursor.execute(BACKUP_CONSULTAS['categorias'])
     for row in cursor.fetchall():
         ws3.append(list(row))
     
@@ -801,7 +1884,7 @@ def generar_backup_excel() -> Path:
     for col in range(1, 4):
         ws4.cell(row=1, column=col).fill = header_fill
         ws4.cell(row=1, column=col).font = header_font
-    cursor.execute("SELECT * FROM producto_categoria")
+    cursor.execute(BACKUP_CONSULTAS['producto_categoria'])
     for row in cursor.fetchall():
         ws4.append(list(row))
     
@@ -816,7 +1899,14 @@ def generar_backup_excel() -> Path:
 
 
 @app.get("/descargar/backup")
-async def descargar_backup():
+async def descargar_backup(formato: str = 'xlsx'):
+    # Varias tablas: solo JSONL (cada fila lleva su tabla), no CSV plano
+    formato = validar_formato(formato, ('xlsx', 'jsonl', 'jsonl.gz'))
+    if formato != 'xlsx':
+        consultas = [(sql, (), {'tabla': tabla}) for tabla, sql in BACKUP_CONSULTAS.items()]
+        fecha_str = datetime.now().strftime("%Y-%m-%d_%H%M")
+        return respuesta_exportacion(consultas, formato, f"backup_vega_{fecha_str}")
+    
     filepath = generar_backup_excel()
     return FileResponse(filepath, filename=filepath.name, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
@@ -863,12 +1953,19 @@ async def restaurar_backup(file: UploadFile = File(...), auto_completar: bool =
             ws = wb["Lineas"]
             for row in ws.iter_rows(min_row=2, values_only=True):
                 if row[0] and row[1]:
-                    cursor.execute('INSERT OR REPLACE INTO lineas_pedido (id, pedido_id, producto, cantidad, precio, sku) VALUES (?, ?, ?, ?, ?, ?)', row)
+                    cursor.execute('INSERT OR REPLACE INTO lineas_pedido (id, pedido_id, producto, cantidad, precio, sku) VALUES (?, ?, ?, ?, ?, ?)', row[:6])
                     stats['lineas'] += 1
         
+        indexar_busqueda(cursor)
+        reconstruir_demanda(cursor)
+        reconstruir_productos(cursor)
+        version = incrementar_version(cursor)
+        
         conn.commit()
         conn.close()
         
+        publicar_evento({'tipo': 'recarga', 'version': version})
+        
         return {"success": True, "estadisticas": stats}
     finally:
         if temp_path.exists():
@@ -893,6 +1990,380 @@ async def set_backup_config(email: str = Form(''), frecuencia_dias: int = Form(3
     return {"success": True}
 
 
+# ============================================
+# ANALÍTICA DE DEMANDA
+# ============================================
+
+# Expresión SQL del período para cada agrupación (semanas de lunes a domingo)
+PERIODOS_ANALITICA = {
+    'dia': "fecha",
+    'semana': "date(fecha, '-6 days', 'weekday 1')",
+    'mes': "strftime('%Y-%m', fecha)",
+}
+
+
+def _periodos(desde: date, hasta: date, agrupar: str) -> list:
+    """Todos los períodos del rango, para completar con ceros los que no tienen demanda."""
+    periodos = []
+    if agrupar == 'dia':
+        actual = desde
+        while actual <= hasta:
+            periodos.append(actual.isoformat())
+            actual += timedelta(days=1)
+    elif agrupar == 'semana':
+        actual = desde - timedelta(days=desde.weekday())
+        while actual <= hasta:
+            periodos.append(actual.isoformat())
+            actual += timedelta(days=7)
+    else:
+        anio, mes = desde.year, desde.month
+        while (anio, mes) <= (hasta.year, hasta.month):
+            periodos.append(f"{anio:04d}-{mes:02d}")
+            anio, mes = (anio + 1, 1) if mes == 12 else (anio, mes + 1)
+    return periodos
+
+
+def _media_movil(valores: list, ventana: int) -> list:
+    """Media móvil simple con suma acumulada (los primeros puntos usan la ventana disponible)."""
+    resultado = []
+    suma = 0
+    for i, valor in enumerate(valores):
+        suma += valor
+        if i >= ventana:
+            suma -= valores[i - ventana]
+        resultado.append(round(suma / min(i + 1, ventana), 2))
+    return resultado
+
+
+def _rango_analitica(desde: Optional[str], hasta: Optional[str]) -> tuple:
+    try:
+        d = date.fromisoformat(desde) if desde else date.today() - timedelta(weeks=12)
+        h = date.fromisoformat(hasta) if hasta else date.today() + timedelta(weeks=2)
+    except ValueError:
+        raise HTTPException(400, "Fechas inválidas (usar AAAA-MM-DD)")
+    if d > h:
+        raise HTTPException(400, "'desde' debe ser anterior a 'hasta'")
+    return d, h
+
+
+@app.get("/api/analitica/demanda")
+async def analitica_demanda(
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    agrupar: str = 'semana',
+    por: Optional[str] = None,
+    producto: Optional[str] = None,
+    comuna: Optional[str] = None,
+    ventana: int = 4,
+    n: int = 10
+):
+    """
+    Serie de demanda (cantidad y revenue) por período, con media móvil.
+    Con por=producto o por=comuna devuelve una serie por cada uno de los n principales.
+    """
+    if agrupar not in PERIODOS_ANALITICA:
+        raise HTTPException(400, f"agrupar debe ser uno de: {', '.join(PERIODOS_ANALITICA)}")
+    if por not in (None, 'producto', 'comuna'):
+        raise HTTPException(400, "por debe ser 'producto' o 'comuna'")
+    d, h = _rango_analitica(desde, hasta)
+    ventana = max(1, ventana)
+    n = max(1, n)
+    
+    where = "WHERE fecha BETWEEN ? AND ?"
+    params = [d.isoformat(), h.isoformat()]
+    if producto:
+        where += " AND producto = ?"
+        params.append(producto)
+    if comuna:
+        where += " AND comuna = ?"
+        params.append(comuna)
+    
+    clave = por or "'total'"
+    periodo = PERIODOS_ANALITICA[agrupar]
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    claves = None
+    if por:
+        # Limitar a los n principales por cantidad en el rango
+        cursor.execute(f'''
+            SELECT {por} FROM demanda_diaria {where}
+            GROUP BY {por} ORDER BY SUM(cantidad) DESC LIMIT ?
+        ''', params + [n])
+        claves = [row[0] for row in cursor.fetchall()]
+        if claves:
+            where += f" AND {por} IN ({','.join('?' * len(claves))})"
+            params += claves
+    
+    cursor.execute(f'''
+        SELECT {clave} AS clave, {periodo} AS periodo, SUM(cantidad) AS cantidad, SUM(revenue) AS revenue
+        FROM demanda_diaria
+        {where}
+        GROUP BY clave, periodo
+    ''', params)
+    filas = cursor.fetchall()
+    conn.close()
+    
+    periodos = _periodos(d, h, agrupar)
+    indice = {p: i for i, p in enumerate(periodos)}
+    
+    acumulado = {}
+    for row in filas:
+        serie = acumulado.setdefault(row['clave'], ([0] * len(periodos), [0.0] * len(periodos)))
+        i = indice.get(row['periodo'])
+        if i is not None:
+            serie[0][i] = row['cantidad']
+            serie[1][i] = round(row['revenue'], 2)
+    
+    series = {}
+    for nombre in (claves if por else acumulado.keys()):
+        cantidades, revenues = acumulado.get(nombre, ([0] * len(periodos), [0.0] * len(periodos)))
+        medias = _media_movil(cantidades, ventana)
+        series[nombre] = [
+            {"periodo": p, "cantidad": c, "revenue": r, "media_movil": m}
+            for p, c, r, m in zip(periodos, cantidades, revenues, medias)
+        ]
+    
+    return {
+        "desde": d.isoformat(),
+        "hasta": h.isoformat(),
+        "agrupar": agrupar,
+        "ventana": ventana,
+        "series": series
+    }
+
+
+@app.get("/api/analitica/top-productos")
+async def analitica_top_productos(
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    comuna: Optional[str] = None,
+    orden: str = 'cantidad',
+    n: int = 10
+):
+    """Productos con más demanda en el rango, por cantidad o revenue."""
+    if orden not in ('cantidad', 'revenue'):
+        raise HTTPException(400, "orden debe ser 'cantidad' o 'revenue'")
+    d, h = _rango_analitica(desde, hasta)
+    
+    where = "WHERE fecha BETWEEN ? AND ?"
+    params = [d.isoformat(), h.isoformat()]
+    if comuna:
+        where += " AND comuna = ?"
+        params.append(comuna)
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT producto, SUM(cantidad) AS cantidad, ROUND(SUM(revenue), 2) AS revenue, SUM(lineas) AS lineas
+        FROM demanda_diaria
+        {where}
+        GROUP BY producto
+        ORDER BY {orden} DESC
+        LIMIT ?
+    ''', params + [max(1, n)])
+    productos = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+    
+    return {"desde": d.isoformat(), "hasta": h.isoformat(), "orden": orden, "productos": productos}
+
+
+@app.post("/api/analitica/reconstruir")
+async def analitica_reconstruir():
+    """Recalcula las tablas de demanda y productos desde cero."""
+    conn = get_db()
+    cursor = conn.cursor()
+    reconstruir_demanda(cursor)
+    reconstruir_productos(cursor)
+    cursor.execute("SELECT COUNT(*) FROM demanda_diaria")
+    filas = cursor.fetchone()[0]
+    conn.commit()
+    conn.close()
+    return {"success": True, "filas": filas}
+
+
+# ============================================
+# PRECÁLCULO DE DESCARGAS
+# ============================================
+
+PRECALCULO_DIR = OUTPUT_DIR / "precalculo"
+
+# Un archivo que sale del cache se borra recién pasada esta gracia (segundos):
+# una descarga puede haberlo obtenido de cache_obtener y todavía no abrirlo
+PRECALCULO_GRACIA = 600
+
+# (tipo, fecha) -> (data_version, resultado). Se invalida al cambiar la versión de los datos.
+_cache_precalculo = {}
+# Archivo -> momento en que dejó de estar en el cache
+_liberados = {}
+_cache_lock = threading.Lock()
+_precalculo_lock = threading.Lock()
+
+
+def dir_precalculo() -> Path:
+    """Directorio propio del proceso: con uvicorn --workers cada worker tiene su cache."""
+    directorio = PRECALCULO_DIR / str(os.getpid())
+    directorio.mkdir(parents=True, exist_ok=True)
+    return directorio
+
+
+def _proceso_vivo(pid: str) -> bool:
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def cache_obtener(tipo: str, fecha: str):
+    """Resultado precalculado si sigue vigente para la versión actual de los datos; si no, None."""
+    entrada = _cache_precalculo.get((tipo, fecha))
+    if not entrada or entrada[0] != get_data_version():
+        return None
+    resultado = entrada[1]
+    if isinstance(resultado, Path) and not resultado.exists():
+        return None
+    return resultado
+
+
+def _cache_guardar(tipo: str, fecha: str, version: int, resultado):
+    with _cache_lock:
+        anterior = _cache_precalculo.get((tipo, fecha))
+        _cache_precalculo[(tipo, fecha)] = (version, resultado)
+        # El archivo reemplazado se borra en una limpieza posterior
+        if anterior and isinstance(anterior[1], Path) and anterior[1] != resultado:
+            _liberados[anterior[1]] = time.time()
+
+
+def limpiar_precalculo(fechas: Optional[list] = None):
+    """
+    Borra del disco los archivos precalculados que el cache ya no usa, pasada
+    la gracia. Con fechas, antes saca del cache las fechas que quedaron fuera
+    de la ventana. Los directorios de procesos que ya no existen se borran enteros.
+    """
+    ahora = time.time()
+    with _cache_lock:
+        if fechas is not None:
+            for clave in [clave for clave in _cache_precalculo if clave[1] not in fechas]:
+                _, resultado = _cache_precalculo.pop(clave)
+                if isinstance(resultado, Path):
+                    _liberados.setdefault(resultado, ahora)
+        vigentes = {resultado for _, resultado in _cache_precalculo.values() if isinstance(resultado, Path)}
+        liberados = dict(_liberados)
+    
+    propio = dir_precalculo()
+    for archivo in propio.iterdir():
+        if archivo in vigentes:
+            continue
+        try:
+            # Los que no pasaron por el cache (de un proceso anterior con el mismo pid) cuentan desde su creación
+            desde = liberados.get(archivo) or archivo.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        if ahora - desde >= PRECALCULO_GRACIA:
+            archivo.unlink(missing_ok=True)
+            with _cache_lock:
+                _liberados.pop(archivo, None)
+    
+    for entrada in PRECALCULO_DIR.iterdir():
+        if entrada == propio:
+            continue
+        if entrada.is_dir():
+            if not _proceso_vivo(entrada.name):
+                shutil.rmtree(entrada, ignore_errors=True)
+        else:
+            entrada.unlink(missing_ok=True)
+
+
+def proximas_fechas_entrega(dias: int) -> list:
+    """Las próximas N fechas de entrega (desde hoy) con pedidos activos."""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT DISTINCT fecha_entrega FROM pedidos
+        WHERE fecha_entrega >= ? AND status IN ('pendiente', 'postergado')
+        ORDER BY fecha_entrega
+        LIMIT ?
+    ''', (date.today().isoformat(), dias))
+    fechas = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    return fechas
+
+
+def precalcular_fecha(fecha: str):
+    """Precalcula la lista de compras y los dos Excel de una fecha."""
+    # La versión se lee antes que los datos: si cambian entremedio, la entrada
+    # queda con una versión vieja y se regenera al pedirla.
+    version = get_data_version()
+    
+    lista = calcular_lista_compras(fecha)
+    _cache_guardar('lista_compras', fecha, version, lista)
+    
+    filepath = generar_lista_compras_excel(fecha, lista, dir_precalculo() / f"lista_compras_{fecha}_v{version}.xlsx")
+    _cache_guardar('lista_compras_xlsx', fecha, version, filepath)
+    
+    pedidos = consultar_pedidos(fecha=fecha, status='activo')
+    filepath = generar_pedidos_armado_excel(fecha, pedidos, dir_precalculo() / f"pedidos_armado_{fecha}_v{version}.xlsx")
+    _cache_guardar('pedidos_armado_xlsx', fecha, version, filepath)
+
+
+def precalcular_proximas_fechas() -> list:
+    """Precalcula las descargas de las próximas fechas de entrega (configurable)."""
+    dias = int(get_config('precalculo_dias') or 2)
+    with _precalculo_lock:
+        fechas = proximas_fechas_entrega(dias)
+        limpiar_precalculo(fechas)
+        for fecha in fechas:
+            precalcular_fecha(fecha)
+    return fechas
+
+
+async def _programador_precalculo():
+    """Ejecuta el precálculo una vez al día a la hora configurada."""
+    ultima_ejecucion = None
+    while True:
+        await asyncio.sleep(60)
+        ahora = datetime.now()
+        hora = get_config('precalculo_hora')
+        if hora and ahora.strftime('%H:%M') >= hora and ultima_ejecucion != ahora.date():
+            ultima_ejecucion = ahora.date()
+            try:
+                await asyncio.to_thread(precalcular_proximas_fechas)
+            except Exception:
+                logger.exception("Error en precálculo programado")
+
+
+@app.on_event("startup")
+async def iniciar_programador_precalculo():
+    # Archivos de ejecuciones anteriores del servidor, que no están en el cache
+    limpiar_precalculo()
+    asyncio.create_task(_programador_precalculo())
+
+
+@app.get("/api/precalculo/config")
+async def get_precalculo_config():
+    return {
+        "dias": int(get_config('precalculo_dias') or 2),
+        "hora": get_config('precalculo_hora')
+    }
+
+
+@app.post("/api/precalculo/config")
+async def set_precalculo_config(dias: int = Form(2), hora: str = Form('05:30')):
+    set_config('precalculo_dias', str(dias))
+    set_config('precalculo_hora', hora)
+    return {"success": True}
+
+
+@app.post("/api/precalculo/ejecutar")
+async def ejecutar_precalculo():
+    fechas = await asyncio.to_thread(precalcular_proximas_fechas)
+    return {"success": True, "fechas": fechas, "version": get_data_version()}
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
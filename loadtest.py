@@ -0,0 +1,408 @@
+"""
+Prueba de carga HTTP - La Vega
+Levanta la app con uvicorn sobre una vega.db temporal con datos de prueba y
+simula un día de operación con varios operadores a la vez.
+
+Uso:
+    python loadtest.py --concurrencia 5 --duracion 60 --salida reporte
+    python loadtest.py --comparar reporte_anterior.json
+
+Genera reporte.json y reporte.md con latencia p50/p95/p99 por ruta,
+throughput y tasa de errores.
+"""
+
+import argparse
+import csv
+import http.client
+import io
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+
+COMUNAS = [
+    'Ñuñoa', 'Providencia', 'Las Condes', 'Vitacura', 'La Reina',
+    'Macul', 'Santiago', 'Maipú', 'La Florida', 'Peñalolén'
+]
+
+PRODUCTOS = [
+    'Lechuga Escarola', 'Tomate', 'Palta Hass', 'Cebolla', 'Papa', 'Zanahoria',
+    'Zapallo Italiano', 'Pimentón Rojo', 'Limón', 'Naranja', 'Plátano', 'Manzana Fuji',
+    'Frutilla', 'Arándano', 'Uva Red Globe', 'Pera', 'Kiwi', 'Brócoli', 'Coliflor',
+    'Espinaca', 'Cilantro', 'Perejil', 'Ajo', 'Choclo', 'Porotos Verdes', 'Betarraga',
+    'Pepino', 'Apio', 'Champiñón', 'Huevos 12 un', 'Queso Mantecoso', 'Leche Entera',
+    'Pollo Entero', 'Posta Negra', 'Arroz Grado 1', 'Aceite de Oliva', 'Mango',
+    'Piña', 'Sandía', 'Melón Tuna'
+]
+
+# Mezcla de operaciones de un día normal (peso relativo)
+MEZCLA = [
+    ('home', 20),
+    ('pedidos_fecha', 35),
+    ('fechas_pendientes', 10),
+    ('completar', 12),
+    ('postergar', 5),
+    ('lista_compras', 10),
+    ('pedidos_armado', 8),
+]
+
+COLUMNAS_SHOPIFY = [
+    'Name', 'Email', 'Note Attributes', 'Shipping Name', 'Shipping Address1', 'Phone',
+    'Total', 'Created at', 'Lineitem name', 'Lineitem quantity', 'Lineitem price', 'Lineitem sku'
+]
+
+
+# ============================================
+# DATOS DE PRUEBA
+# ============================================
+
+def generar_csv_shopify(desde: int, cantidad: int, fechas: list, rng: random.Random) -> str:
+    """CSV con el formato de exportación de Shopify (una fila por línea de pedido)."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNAS_SHOPIFY)
+
+    for n in range(desde, desde + cantidad):
+        fecha = rng.choice(fechas)
+        comuna = rng.choice(COMUNAS)
+        items = rng.sample(PRODUCTOS, rng.randint(3, 12))
+        note = f"Comuna de Entrega: {comuna}\nFecha de Entrega: {fecha}"
+
+        for i, producto in enumerate(items):
+            cantidad_item = rng.randint(1, 4)
+            precio = rng.choice([490, 990, 1490, 1990, 2990, 4990])
+            if i == 0:
+                writer.writerow([
+                    f'#{n}', f'cliente{n}@example.com', note, f'Cliente {n}',
+                    f'Calle {rng.randint(1, 300)} #{rng.randint(100, 9999)}', f'+56 9 {rng.randint(10000000, 99999999)}',
+                    precio * cantidad_item * len(items), '2024-01-01 10:00:00 -0300',
+                    producto, cantidad_item, precio, f'SKU-{PRODUCTOS.index(producto)}'
+                ])
+            else:
+                writer.writerow([f'#{n}', '', '', '', '', '', '', '', producto, cantidad_item, precio, f'SKU-{PRODUCTOS.index(producto)}'])
+
+    return buffer.getvalue()
+
+
+def cuerpo_multipart(campo: str, filename: str, contenido: bytes, content_type: str, campos: dict = None) -> tuple:
+    """Cuerpo multipart/form-data con un archivo y campos de formulario opcionales."""
+    boundary = uuid.uuid4().hex
+    cuerpo = b''.join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{nombre}"\r\n\r\n{valor}\r\n'.encode('utf-8')
+        for nombre, valor in (campos or {}).items()
+    )
+    cuerpo += (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="{campo}"; filename="{filename}"\r\n'
+        f'Content-Type: {content_type}\r\n\r\n'
+    ).encode('utf-8') + contenido + f'\r\n--{boundary}--\r\n'.encode('utf-8')
+    return cuerpo, f'multipart/form-data; boundary={boundary}'
+
+
+# ============================================
+# SERVIDOR
+# ============================================
+
+def puerto_libre() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def iniciar_servidor(tmpdir: Path, puerto: int, workers: int) -> subprocess.Popen:
+    env = dict(os.environ)
+    env['VEGA_DB_PATH'] = str(tmpdir / 'vega.db')
+    env['VEGA_OUTPUT_DIR'] = str(tmpdir / 'outputs')
+    log = open(tmpdir / 'uvicorn.log', 'wb')
+    proceso = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'app:app', '--host', '127.0.0.1', '--port', str(puerto),
+         '--workers', str(workers), '--log-level', 'warning'],
+        cwd=BASE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+
+    limite = time.time() + 30
+    while time.time() < limite:
+        if proceso.poll() is not None:
+            raise RuntimeError(f"uvicorn terminó al iniciar; ver {tmpdir / 'uvicorn.log'}")
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', puerto, timeout=2)
+            conn.request('GET', '/api/fechas-pendientes')
+            conn.getresponse().read()
+            conn.close()
+            return proceso
+        except OSError:
+            time.sleep(0.2)
+    proceso.terminate()
+    raise RuntimeError("uvicorn no respondió a tiempo")
+
+
+# ============================================
+# CLIENTE
+# ============================================
+
+class Operador:
+    """Un operador con su propia conexión keep-alive al servidor."""
+
+    def __init__(self, puerto: int, resultados: list, lock: threading.Lock):
+        self.puerto = puerto
+        self.resultados = resultados
+        self.lock = lock
+        self.conn = None
+
+    def request(self, ruta: str, metodo: str, url: str, body: bytes = None, headers: dict = None):
+        inicio = time.perf_counter()
+        status = None
+        error = None
+        datos = b''
+        for intento in range(2):
+            try:
+                if self.conn is None:
+                    self.conn = http.client.HTTPConnection('127.0.0.1', self.puerto, timeout=120)
+                self.conn.request(metodo, url, body=body, headers=headers or {})
+                respuesta = self.conn.getresponse()
+                datos = respuesta.read()
+                status = respuesta.status
+                break
+            except (http.client.HTTPException, OSError) as e:
+                # Conexión cerrada por el servidor: reintentar una vez con una nueva
+                self.conn = None
+                error = str(e)
+        latencia = time.perf_counter() - inicio
+        with self.lock:
+            self.resultados.append({
+                'ruta': ruta,
+                'status': status,
+                'latencia': latencia,
+                'bytes': len(datos),
+                'error': error if status is None else None
+            })
+        return status, datos
+
+
+def ejecutar_operacion(op: Operador, nombre: str, ctx: dict, rng: random.Random):
+    fecha = rng.choice(ctx['fechas_activas'])
+
+    if nombre == 'home':
+        op.request('GET /', 'GET', '/')
+    elif nombre == 'pedidos_fecha':
+        op.request('GET /api/pedidos?fecha=', 'GET', f'/api/pedidos?fecha={fecha}&status=activo')
+    elif nombre == 'fechas_pendientes':
+        op.request('GET /api/fechas-pendientes', 'GET', '/api/fechas-pendientes')
+    elif nombre == 'completar':
+        pedido_id = rng.randint(1, ctx['total_pedidos'])
+        op.request('POST completar', 'POST', f'/api/pedidos/{pedido_id}/completar')
+    elif nombre == 'postergar':
+        pedido_id = rng.randint(1, ctx['total_pedidos'])
+        nueva = (date.fromisoformat(fecha) + timedelta(days=1)).isoformat()
+        op.request('POST postergar', 'POST', f'/api/pedidos/{pedido_id}/postergar',
+                   body=f'nueva_fecha={nueva}'.encode(),
+                   headers={'Content-Type': 'application/x-www-form-urlencoded'})
+    elif nombre == 'lista_compras':
+        op.request('GET lista-compras xlsx', 'GET', f'/descargar/lista-compras/{fecha}')
+    elif nombre == 'pedidos_armado':
+        op.request('GET pedidos-armado xlsx', 'GET', f'/descargar/pedidos-armado/{fecha}')
+
+
+def trabajador(indice: int, puerto: int, ctx: dict, fin: float, resultados: list, lock: threading.Lock, semilla: int):
+    rng = random.Random(semilla + indice)
+    op = Operador(puerto, resultados, lock)
+    nombres = [n for n, _ in MEZCLA]
+    pesos = [p for _, p in MEZCLA]
+
+    # Eventos únicos del día: una importación al principio y un backup a la mitad
+    eventos = ctx['eventos_unicos'].get(indice, [])
+
+    while time.time() < fin:
+        ahora = time.time()
+        if eventos and ahora >= eventos[0][0]:
+            _, nombre = eventos.pop(0)
+            if nombre == 'upload':
+                cuerpo, content_type = cuerpo_multipart('file', 'orders_export.csv', ctx['csv_upload'].encode('utf-8'), 'text/csv')
+                op.request('POST /upload', 'POST', '/upload', body=cuerpo, headers={'Content-Type': content_type})
+            else:
+                op.request('GET /descargar/backup', 'GET', '/descargar/backup')
+            continue
+        ejecutar_operacion(op, rng.choices(nombres, pesos)[0], ctx, rng)
+
+
+# ============================================
+# REPORTE
+# ============================================
+
+def percentil(valores: list, p: float) -> float:
+    """Percentil por rango más cercano (valores ya ordenados)."""
+    if not valores:
+        return 0.0
+    k = max(0, min(len(valores) - 1, math.ceil(p / 100 * len(valores)) - 1))
+    return valores[k]
+
+
+def construir_reporte(resultados: list, duracion: float, parametros: dict) -> dict:
+    por_ruta = {}
+    for r in resultados:
+        por_ruta.setdefault(r['ruta'], []).append(r)
+
+    rutas = {}
+    for ruta, filas in sorted(por_ruta.items()):
+        latencias = sorted(f['latencia'] * 1000 for f in filas)
+        errores = sum(1 for f in filas if f['status'] is None or f['status'] >= 400)
+        rutas[ruta] = {
+            'requests': len(filas),
+            'errores': errores,
+            'tasa_error': round(errores / len(filas), 4),
+            'p50_ms': round(percentil(latencias, 50), 2),
+            'p95_ms': round(percentil(latencias, 95), 2),
+            'p99_ms': round(percentil(latencias, 99), 2),
+            'max_ms': round(latencias[-1], 2),
+            'rps': round(len(filas) / duracion, 2),
+        }
+
+    total_errores = sum(r['errores'] for r in rutas.values())
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+
+    return {
+        'generado': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'parametros': parametros,
+        'duracion_s': round(duracion, 2),
+        'requests': len(resultados),
+        'throughput_rps': round(len(resultados) / duracion, 2),
+        'errores': total_errores,
+        'tasa_error': round(total_errores / len(resultados), 4) if resultados else 0,
+        'rutas': rutas,
+    }
+
+
+def reporte_markdown(reporte: dict, anterior: dict = None) -> str:
+    p = reporte['parametros']
+    lineas = [
+        f"# Prueba de carga - {reporte['generado']}",
+        '',
+        f"Commit `{reporte['commit'] or '-'}` · Python {reporte['python']} · "
+        f"{p['concurrencia']} operadores · {p['duracion']} s · {p['pedidos']} pedidos sembrados",
+        '',
+        f"**Throughput:** {reporte['throughput_rps']} req/s · "
+        f"**Requests:** {reporte['requests']} · **Errores:** {reporte['errores']} ({reporte['tasa_error']:.2%})",
+        '',
+        '| Ruta | Requests | Errores | p50 ms | p95 ms | p99 ms | req/s |' + (' Δ p95 |' if anterior else ''),
+        '|---|---:|---:|---:|---:|---:|---:|' + ('---:|' if anterior else ''),
+    ]
+    for ruta, r in reporte['rutas'].items():
+        fila = f"| {ruta} | {r['requests']} | {r['errores']} | {r['p50_ms']} | {r['p95_ms']} | {r['p99_ms']} | {r['rps']} |"
+        if anterior:
+            previo = anterior.get('rutas', {}).get(ruta)
+            if previo and previo['p95_ms']:
+                fila += f" {(r['p95_ms'] - previo['p95_ms']) / previo['p95_ms']:+.1%} |"
+            else:
+                fila += ' - |'
+        lineas.append(fila)
+    return '\n'.join(lineas) + '\n'
+
+
+# ============================================
+# MAIN
+# ============================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga que simula un día de operación")
+    parser.add_argument('--concurrencia', type=int, default=5, help="operadores simultáneos")
+    parser.add_argument('--duracion', type=float, default=30, help="segundos de prueba")
+    parser.add_argument('--pedidos', type=int, default=2000, help="pedidos sembrados en la DB")
+    parser.add_argument('--dias', type=int, default=14, help="fechas de entrega distintas")
+    parser.add_argument('--workers', type=int, default=1, help="workers de uvicorn")
+    parser.add_argument('--semilla', type=int, default=42)
+    parser.add_argument('--salida', default='loadtest_reporte', help="prefijo de los archivos .json y .md")
+    parser.add_argument('--comparar', help="reporte JSON anterior para comparar p95")
+    args = parser.parse_args()
+
+    rng = random.Random(args.semilla)
+    hoy = date.today()
+    fechas = [(hoy + timedelta(days=i - args.dias // 2)).isoformat() for i in range(args.dias)]
+    fechas_activas = [f for f in fechas if f >= hoy.isoformat()]
+
+    with tempfile.TemporaryDirectory(prefix='vega_loadtest_') as tmp:
+        tmpdir = Path(tmp)
+        puerto = puerto_libre()
+        servidor = iniciar_servidor(tmpdir, puerto, args.workers)
+        try:
+            # Sembrar la DB a través de la misma ruta de importación
+            print(f"Sembrando {args.pedidos} pedidos...")
+            seed = generar_csv_shopify(1000, args.pedidos, fechas, rng)
+            cuerpo, content_type = cuerpo_multipart('file', 'seed.csv', seed.encode('utf-8'), 'text/csv')
+            conn = http.client.HTTPConnection('127.0.0.1', puerto, timeout=300)
+            conn.request('POST', '/upload', body=cuerpo, headers={'Content-Type': content_type})
+            respuesta = json.loads(conn.getresponse().read())
+            conn.close()
+            if not respuesta.get('success'):
+                raise RuntimeError(f"Falló la siembra: {respuesta}")
+
+            inicio = time.time()
+            ctx = {
+                'fechas_activas': fechas_activas,
+                'total_pedidos': args.pedidos,
+                # Nuevos pedidos que se solapan con la siembra, como un export diario
+                'csv_upload': generar_csv_shopify(1000 + args.pedidos - 50, 150, fechas_activas, rng),
+                'eventos_unicos': {
+                    0: [(inicio + args.duracion * 0.1, 'upload')],
+                    1 % args.concurrencia: [(inicio + args.duracion * 0.5, 'backup')],
+                },
+            }
+            if args.concurrencia == 1:
+                ctx['eventos_unicos'] = {0: [(inicio + args.duracion * 0.1, 'upload'), (inicio + args.duracion * 0.5, 'backup')]}
+
+            print(f"Ejecutando {args.duracion:.0f} s con {args.concurrencia} operadores...")
+            resultados = []
+            lock = threading.Lock()
+            fin = inicio + args.duracion
+            hilos = [
+                threading.Thread(target=trabajador, args=(i, puerto, ctx, fin, resultados, lock, args.semilla))
+                for i in range(args.concurrencia)
+            ]
+            for hilo in hilos:
+                hilo.start()
+            for hilo in hilos:
+                hilo.join()
+            duracion = time.time() - inicio
+        finally:
+            servidor.terminate()
+            servidor.wait(timeout=10)
+
+    parametros = {
+        'concurrencia': args.concurrencia,
+        'duracion': args.duracion,
+        'pedidos': args.pedidos,
+        'dias': args.dias,
+        'workers': args.workers,
+        'semilla': args.semilla,
+    }
+    reporte = construir_reporte(resultados, duracion, parametros)
+    anterior = json.loads(Path(args.comparar).read_text()) if args.comparar else None
+    markdown = reporte_markdown(reporte, anterior)
+
+    Path(f"{args.salida}.json").write_text(json.dumps(reporte, indent=2, ensure_ascii=False))
+    Path(f"{args.salida}.md").write_text(markdown)
+    print(markdown)
+    print(f"Reporte guardado en {args.salida}.json y {args.salida}.md")
+
+    return 1 if reporte['errores'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
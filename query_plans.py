@@ -0,0 +1,293 @@
+"""
+Guardia de planes de consulta - La Vega
+Ejecuta las rutas de la app sobre una vega.db temporal con datos de prueba,
+registra cada sentencia SQL que se emite y corre EXPLAIN QUERY PLAN sobre
+cada una.
+
+Falla (exit 1) si alguna sentencia hace SCAN de `pedidos` o `lineas_pedido`
+y no está en la lista de permitidas (PERMITIDAS), p.ej. los volcados del backup.
+
+Uso:
+    python query_plans.py
+    python query_plans.py --pedidos 3000 --salida planes.md
+"""
+
+import argparse
+import asyncio
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import random
+from datetime import date, timedelta
+from pathlib import Path
+from urllib.parse import urlencode
+
+# Tablas cuyo SCAN completo es una regresión en rutas de uso diario
+TABLAS_VIGILADAS = ('pedidos', 'lineas_pedido')
+
+# (patrón sobre el SQL normalizado, motivo)
+PERMITIDAS = [
+    (r"^SELECT id, order_number, email, .* FROM pedidos$",
+     "volcado completo del backup"),
+    (r"^SELECT id, pedido_id, producto, cantidad, precio, sku FROM lineas_pedido$",
+     "volcado completo del backup"),
+    (r"^SELECT p\.id, p\.order_number, .* FROM pedidos p$",
+     "reconstrucción completa del índice de búsqueda (restore / arranque)"),
+    (r"^SELECT \(SELECT COUNT\(\*\) FROM pedidos\) != \(SELECT COUNT\(\*\) FROM pedidos_fts\)$",
+     "chequeo de sincronía del índice de búsqueda al arrancar"),
+    (r"^INSERT INTO demanda_diaria .* FROM pedidos p JOIN lineas_pedido lp ON lp\.pedido_id = p\.id WHERE p\.fecha_entrega IS NOT NULL GROUP BY",
+     "reconstrucción completa del rollup de demanda (restore / arranque / manual)"),
+    (r"^INSERT INTO productos \(producto, lineas\) SELECT producto, COUNT\(\*\) FROM lineas_pedido GROUP BY producto$",
+     "reconstrucción completa de productos (restore / arranque / manual)"),
+    (r"^SELECT EXISTS \(SELECT \? FROM lineas_pedido\) AND NOT EXISTS \(SELECT \? FROM (demanda_diaria|productos)\)$",
+     "chequeo de rollup vacío al arrancar (EXISTS corta en la primera fila)"),
+]
+
+
+# ============================================
+# CLIENTE ASGI MÍNIMO
+# ============================================
+
+async def _asgi(app, metodo: str, ruta: str, body: bytes = b'', headers: dict = None) -> tuple:
+    path, _, query = ruta.partition('?')
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': metodo,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query.encode(),
+        'root_path': '',
+        'headers': [(b'host', b'localhost')] + [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+        'client': ('127.0.0.1', 50000),
+        'server': ('localhost', 80),
+    }
+    recibido = False
+
+    async def receive():
+        nonlocal recibido
+        if not recibido:
+            recibido = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        # El cliente nunca se desconecta; la respuesta cancela esta espera al terminar
+        await asyncio.sleep(3600)
+
+    status = None
+    partes = []
+
+    async def send(mensaje):
+        nonlocal status
+        if mensaje['type'] == 'http.response.start':
+            status = mensaje['status']
+        elif mensaje['type'] == 'http.response.body':
+            partes.append(mensaje.get('body', b''))
+
+    await app(scope, receive, send)
+    return status, b''.join(partes)
+
+
+# ============================================
+# RECOLECCIÓN DE SENTENCIAS
+# ============================================
+
+def normalizar(sql: str) -> str:
+    """Reemplaza literales por ? y colapsa listas IN para agrupar sentencias iguales."""
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])", '?', sql)
+    sql = re.sub(r"\s+", ' ', sql).strip()
+    sql = re.sub(r"IN \(\?(?:, ?\?)*\)", 'IN (?…)', sql)
+    return sql
+
+
+class Recolector:
+    def __init__(self):
+        self.ruta_actual = 'arranque'
+        self.sentencias = {}  # sql normalizado -> {'ejemplo', 'rutas', 'veces'}
+
+    def registrar(self, sql: str):
+        if not re.match(r'\s*(SELECT|INSERT|UPDATE|DELETE|WITH|REPLACE)\b', sql, re.I):
+            return
+        clave = normalizar(sql)
+        entrada = self.sentencias.setdefault(clave, {'ejemplo': sql, 'rutas': [], 'veces': 0})
+        entrada['veces'] += 1
+        if self.ruta_actual not in entrada['rutas']:
+            entrada['rutas'].append(self.ruta_actual)
+
+
+def ejercitar_app(app_module, recolector: Recolector, pedidos: int):
+    """Recorre todas las rutas de la app como lo haría un día de uso."""
+    import loadtest
+
+    rng = random.Random(7)
+    hoy = date.today()
+    fechas = [(hoy + timedelta(days=i - 3)).isoformat() for i in range(10)]
+    fecha = hoy.isoformat()
+    manana = (hoy + timedelta(days=1)).isoformat()
+    app = app_module.app
+
+    def llamar(nombre, metodo, ruta, form: dict = None, archivo: tuple = None):
+        recolector.ruta_actual = nombre
+        headers = {}
+        body = b''
+        if form is not None:
+            body = urlencode(form, doseq=True).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if archivo is not None:
+            body, headers['Content-Type'] = loadtest.cuerpo_multipart(
+                'file', archivo[0], archivo[1], 'application/octet-stream', campos=archivo[2] if len(archivo) > 2 else None
+            )
+        status, datos = asyncio.run(_asgi(app, metodo, ruta, body, headers))
+        if status is None or status >= 400:
+            raise RuntimeError(f"{metodo} {ruta} respondió {status}: {datos[:200]!r}")
+        return datos
+
+    seed = loadtest.generar_csv_shopify(1000, pedidos, fechas, rng).encode('utf-8')
+    llamar('POST /upload', 'POST', '/upload', archivo=('seed.csv', seed))
+    cambios = loadtest.generar_csv_shopify(1000 + pedidos - 20, 40, fechas, rng).encode('utf-8')
+    llamar('POST /upload incremental', 'POST', '/upload', archivo=('cambios.csv', cambios, {'incremental': 'true'}))
+
+    llamar('GET /', 'GET', '/')
+    llamar('GET /api/categorias', 'GET', '/api/categorias')
+    llamar('POST /api/categorias', 'POST', '/api/categorias', form={'nombre': 'Especias'})
+    llamar('GET /api/productos-sin-categoria', 'GET', '/api/productos-sin-categoria')
+    llamar('POST /api/asignar-categoria', 'POST', '/api/asignar-categoria', form={'producto': 'Tomate', 'categoria_id': 2})
+    llamar('GET /api/pedidos?fecha=', 'GET', f'/api/pedidos?fecha={fecha}&status=activo')
+    llamar('GET /api/pedidos?status=', 'GET', '/api/pedidos?status=completado')
+    llamar('GET /api/buscar', 'GET', '/api/buscar?q=cliente%2010&status=activo')
+    llamar('GET /api/fechas-pendientes', 'GET', '/api/fechas-pendientes')
+    llamar('GET /api/lista-compras', 'GET', f'/api/lista-compras/{fecha}')
+    llamar('GET /descargar/lista-compras', 'GET', f'/descargar/lista-compras/{fecha}')
+    llamar('GET /descargar/lista-compras csv', 'GET', f'/descargar/lista-compras/{fecha}?formato=csv')
+    llamar('GET /descargar/pedidos-armado', 'GET', f'/descargar/pedidos-armado/{fecha}')
+    llamar('GET /descargar/pedidos-armado jsonl', 'GET', f'/descargar/pedidos-armado/{fecha}?formato=jsonl')
+    llamar('GET /descargar/pedidos-armado comuna', 'GET', f'/descargar/pedidos-armado/{fecha}?particion=comuna')
+    llamar('GET /descargar/pedidos-armado comuna zip', 'GET', f'/descargar/pedidos-armado/{fecha}?particion=comuna&salida=zip')
+    llamar('POST completar', 'POST', '/api/pedidos/1/completar')
+    llamar('POST reactivar', 'POST', '/api/pedidos/1/reactivar')
+    llamar('POST postergar', 'POST', '/api/pedidos/2/postergar', form={'nueva_fecha': manana})
+    llamar('DELETE pedido', 'DELETE', '/api/pedidos/3')
+    llamar('POST /api/pedidos-lote', 'POST', '/api/pedidos-lote/completar',
+           form={'fecha': fecha, 'comuna': 'Ñuñoa', 'status': 'activo'})
+    llamar('POST /api/pedidos-lote ids', 'POST', '/api/pedidos-lote/postergar',
+           form={'ids': ['4', '5', '6'], 'nueva_fecha': manana})
+    llamar('GET /api/pedidos-completados', 'GET', '/api/pedidos-completados')
+    llamar('GET /api/pedidos-pasados-pendientes', 'GET', '/api/pedidos-pasados-pendientes')
+    llamar('POST /api/auto-completar-pasados', 'POST', '/api/auto-completar-pasados')
+    llamar('POST /api/precalculo/ejecutar', 'POST', '/api/precalculo/ejecutar')
+    llamar('GET /api/analitica/demanda', 'GET', '/api/analitica/demanda')
+    llamar('GET /api/analitica/demanda por', 'GET', '/api/analitica/demanda?agrupar=dia&por=comuna&producto=Tomate')
+    llamar('GET /api/analitica/top-productos', 'GET', '/api/analitica/top-productos?orden=revenue&comuna=%C3%91u%C3%B1oa')
+    llamar('POST /api/analitica/reconstruir', 'POST', '/api/analitica/reconstruir')
+    backup = llamar('GET /descargar/backup', 'GET', '/descargar/backup')
+    llamar('GET /descargar/backup jsonl', 'GET', '/descargar/backup?formato=jsonl')
+    llamar('POST /api/backup/restaurar', 'POST', '/api/backup/restaurar', archivo=('backup.xlsx', backup))
+
+
+# ============================================
+# ANÁLISIS DE PLANES
+# ============================================
+
+def alias_vigilados(sql: str) -> set:
+    """Nombres (tabla o alias) con que aparecen las tablas vigiladas en la sentencia."""
+    nombres = set(TABLAS_VIGILADAS)
+    reservadas = {'WHERE', 'JOIN', 'LEFT', 'INNER', 'ON', 'SET', 'GROUP', 'ORDER', 'LIMIT', 'USING', 'VALUES', 'AND', 'AS'}
+    for tabla, alias in re.findall(r'\b(pedidos|lineas_pedido)\b(?:\s+(?:AS\s+)?(\w+))?', sql, re.I):
+        if alias and alias.upper() not in reservadas:
+            nombres.add(alias)
+    return nombres
+
+
+def analizar(db_path: Path, recolector: Recolector) -> list:
+    conn = sqlite3.connect(db_path)
+    resultados = []
+    for clave, entrada in recolector.sentencias.items():
+        try:
+            plan = [fila[3] for fila in conn.execute('EXPLAIN QUERY PLAN ' + entrada['ejemplo'])]
+        except sqlite3.Error as e:
+            plan = [f'(no se pudo explicar: {e})']
+
+        nombres = alias_vigilados(entrada['ejemplo'])
+        scans = [d for d in plan if (m := re.match(r'SCAN (\w+)', d)) and m.group(1) in nombres]
+        permitida = next((motivo for patron, motivo in PERMITIDAS if re.search(patron, clave)), None)
+
+        resultados.append({
+            'sql': clave,
+            'rutas': entrada['rutas'],
+            'veces': entrada['veces'],
+            'plan': plan,
+            'scans': scans,
+            'permitida': permitida,
+            'falla': bool(scans) and not permitida,
+        })
+    conn.close()
+    return resultados
+
+
+def reporte(resultados: list) -> str:
+    lineas = ['# Planes de consulta', '']
+    fallas = [r for r in resultados if r['falla']]
+    lineas.append(f"{len(resultados)} sentencias distintas · {len(fallas)} con SCAN no permitido")
+    lineas.append('')
+    for r in sorted(resultados, key=lambda r: (not r['falla'], r['rutas'][0])):
+        estado = '❌ SCAN' if r['falla'] else ('⚠️ permitido' if r['scans'] else '✅')
+        lineas.append(f"## {estado} · {', '.join(r['rutas'])} · {r['veces']}×")
+        lineas.append('')
+        lineas.append('```sql')
+        lineas.append(r['sql'])
+        lineas.append('```')
+        for detalle in r['plan']:
+            lineas.append(f"- {detalle}")
+        if r['permitida'] and r['scans']:
+            lineas.append(f"- _permitido: {r['permitida']}_")
+        lineas.append('')
+    return '\n'.join(lineas)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verifica los planes de todas las consultas SQL de la app")
+    parser.add_argument('--pedidos', type=int, default=500, help="pedidos sembrados en la DB")
+    parser.add_argument('--salida', help="guardar el reporte en markdown")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='vega_planes_') as tmp:
+        tmpdir = Path(tmp)
+        os.environ['VEGA_DB_PATH'] = str(tmpdir / 'vega.db')
+        os.environ['VEGA_OUTPUT_DIR'] = str(tmpdir / 'outputs')
+        sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+        import app as app_module
+
+        recolector = Recolector()
+        get_db_original = app_module.get_db
+
+        def get_db_trazado(*a, **kw):
+            conn = get_db_original(*a, **kw)
+            conn.set_trace_callback(recolector.registrar)
+            return conn
+
+        app_module.get_db = get_db_trazado
+        app_module.init_db()
+        ejercitar_app(app_module, recolector, args.pedidos)
+
+        resultados = analizar(tmpdir / 'vega.db', recolector)
+
+    texto = reporte(resultados)
+    if args.salida:
+        Path(args.salida).write_text(texto)
+    print(texto)
+
+    fallas = [r for r in resultados if r['falla']]
+    if fallas:
+        print(f"\n{len(fallas)} sentencia(s) con SCAN de {'/'.join(TABLAS_VIGILADAS)} fuera de la lista permitida:")
+        for r in fallas:
+            print(f"  - [{', '.join(r['rutas'])}] {r['sql'][:140]}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+import csv
+import io
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# Base de datos y salidas temporales, antes de importar la app
+_TMP = Path(tempfile.mkdtemp(prefix='vega-tests-'))
+os.environ['VEGA_DB_PATH'] = str(_TMP / 'vega.db')
+os.environ['VEGA_OUTPUT_DIR'] = str(_TMP / 'outputs')
+os.environ.setdefault('VEGA_WORKERS', '2')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import app as app_module  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+COLUMNAS = [
+    'Name', 'Email', 'Note Attributes', 'Shipping Name', 'Shipping Address1', 'Phone', 'Total',
+    'Created at', 'Lineitem name', 'Lineitem quantity', 'Lineitem price', 'Lineitem sku'
+]
+
+
+def filas_pedido(numero: str, fecha: str, comuna: str, items: list) -> list:
+    """Filas de un pedido como las exporta Shopify: datos del pedido solo en la primera."""
+    filas = []
+    for i, (producto, cantidad, precio) in enumerate(items):
+        if i == 0:
+            filas.append([
+                numero, f'{numero[1:]}@example.com', f'Comuna de Entrega: {comuna}\nFecha de Entrega: {fecha}',
+                f'Cliente {numero}', f'Calle {numero[1:]}', '+56 9 1234 5678',
+                sum(c * p for _, c, p in items), '2024-01-01 10:00:00 -0300', producto, cantidad, precio, ''
+            ])
+        else:
+            filas.append([numero, '', '', '', '', '', '', '', producto, cantidad, precio, ''])
+    return filas
+
+
+def csv_shopify(filas: list) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNAS)
+    writer.writerows(filas)
+    return buffer.getvalue().encode('utf-8')
+
+
+def subir(client, filas: list, incremental: bool = False) -> dict:
+    """Importa las filas como un CSV de Shopify por /upload."""
+    r = client.post(
+        '/upload',
+        files={'file': ('pedidos.csv', csv_shopify(filas), 'text/csv')},
+        data={'incremental': 'true' if incremental else 'false'}
+    )
+    assert r.status_code == 200, r.text
+    return r.json()
+
+
+@pytest.fixture
+def client():
+    with TestClient(app_module.app) as c:
+        conn = app_module.get_db()
+        for tabla in ('lineas_pedido', 'pedidos', 'pedidos_fts', 'demanda_diaria', 'productos', 'producto_categoria'):
+            conn.execute(f"DELETE FROM {tabla}")
+        conn.commit()
+        conn.close()
+        yield c
+
+
+@pytest.fixture
+def db():
+    conn = app_module.get_db()
+    yield conn
+    conn.close()
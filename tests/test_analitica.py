@@ -0,0 +1,18 @@
+import pytest
+
+from conftest import filas_pedido, subir
+
+FECHA = '2030-03-04'
+
+
+@pytest.mark.parametrize('n', [0, -1])
+def test_analitica_demanda_con_n_no_positivo_devuelve_una_serie(client, n):
+    filas = filas_pedido('#1', FECHA, 'Macul', [('Tomate', 3, 990), ('Apio', 1, 490)])
+    subir(client, filas)
+
+    resp = client.get('/api/analitica/demanda', params={
+        'desde': FECHA, 'hasta': FECHA, 'agrupar': 'dia', 'por': 'producto', 'n': n,
+    })
+
+    assert resp.status_code == 200
+    assert list(resp.json()['series']) == ['Tomate']
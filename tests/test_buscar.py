@@ -0,0 +1,84 @@
+from conftest import filas_pedido, subir
+
+FECHA = '2030-03-04'
+
+
+def pedido(numero, comuna, nombre, direccion, telefono, items=(('Tomate', 1, 990),), fecha=FECHA):
+    filas = filas_pedido(numero, fecha, comuna, list(items))
+    filas[0][3:6] = [nombre, direccion, telefono]
+    return filas
+
+
+def importar(client, incremental=False, extra=()):
+    filas = pedido('#1', 'Ñuñoa', 'María José Pérez', 'Irarrázaval 2401', '+56 9 8765 4321', [('Palta Hass', 2, 2990)])
+    filas += pedido('#2', 'Macul', 'José Miguel Rojas', 'Av. Macul 1500', '+56 2 2345 6789')
+    filas += pedido('#3', 'La Reina', 'Ana María Soto', 'Larraín 5800', '+56 9 1111 2222')
+    for n in range(4, 30):
+        filas += pedido(f'#{n}', 'Providencia', f'Cliente Frecuente {n}', f'Calle {n}', f'+56 9 5555 {n:04d}')
+    return subir(client, filas + list(extra), incremental)
+
+
+def buscar(client, q, **params):
+    return client.get('/api/buscar', params={'q': q, **params}).json()
+
+
+def numeros(datos):
+    return {r['order_number'] for r in datos['resultados']}
+
+
+def test_prefijos_de_varias_palabras(client):
+    importar(client)
+    assert numeros(buscar(client, 'jos')) == {'#1', '#2'}
+    assert numeros(buscar(client, 'jos ro')) == {'#2'}
+    assert numeros(buscar(client, 'mar pér')) == {'#1'}
+    assert numeros(buscar(client, 'palta')) == {'#1'}
+
+
+def test_sin_acentos(client):
+    importar(client)
+    assert numeros(buscar(client, 'nunoa')) == {'#1'}
+    assert numeros(buscar(client, 'irarrazaval')) == {'#1'}
+    assert numeros(buscar(client, 'LARRAIN')) == {'#3'}
+
+
+def test_telefono_solo_digitos(client):
+    importar(client)
+    assert numeros(buscar(client, '987654321')) == {'#1'}
+    assert numeros(buscar(client, '56987654321')) == {'#1'}
+    assert numeros(buscar(client, '22345')) == {'#2'}
+
+
+def test_filtro_status(client):
+    importar(client)
+    pedido_id = buscar(client, 'macul')['resultados'][0]['id']
+    client.post(f'/api/pedidos/{pedido_id}/completar')
+
+    assert numeros(buscar(client, 'jos', status='activo')) == {'#1'}
+    assert numeros(buscar(client, 'jos', status='completado')) == {'#2'}
+
+
+def test_paginacion(client):
+    importar(client)
+    primera = buscar(client, 'frecuente', limit=10)
+    tercera = buscar(client, 'frecuente', limit=10, offset=20)
+
+    assert primera['total'] == tercera['total'] == 26
+    assert len(primera['resultados']) == 10 and len(tercera['resultados']) == 6
+    assert not numeros(primera) & numeros(tercera)
+
+
+def test_indice_tras_eliminar_y_actualizar(client):
+    importar(client)
+    pedido_id = buscar(client, 'larrain')['resultados'][0]['id']
+    client.delete(f'/api/pedidos/{pedido_id}')
+    assert buscar(client, 'larrain')['total'] == 0
+
+    # #2 cambia de dirección y producto en Shopify
+    cambio = pedido('#2', 'Macul', 'José Miguel Rojas', 'Quilín 3300', '+56 2 2345 6789', [('Frambuesa', 1, 3990)])
+    stats = subir(client, cambio, incremental=True)
+
+    assert stats['actualizados'] == 1
+    assert numeros(buscar(client, 'quilin')) == {'#2'}
+    assert numeros(buscar(client, 'frambuesa')) == {'#2'}
+    assert buscar(client, 'av macul')['total'] == 0
+    assert buscar(client, 'tomate')['total'] == 26
@@ -0,0 +1,57 @@
+import asyncio
+import re
+
+from starlette.requests import Request
+
+import app as app_module
+
+
+def version_de_la_pagina(client):
+    return int(re.search(r'let versionDatos = (\d+);', client.get('/').text).group(1))
+
+
+def primeros_eventos(headers: dict, cantidad: int, al_suscribir=None) -> list:
+    """Nombres de los primeros eventos del stream SSE, leyendo el generador directamente."""
+    async def leer():
+        async def receive():
+            await asyncio.sleep(3600)
+
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': '/api/eventos', 'query_string': b'',
+            'headers': [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+        }
+        respuesta = await app_module.eventos(Request(scope, receive))
+        if al_suscribir:
+            al_suscribir()
+        eventos = []
+        async for trozo in respuesta.body_iterator:
+            eventos += re.findall(r'^event: (\w+)', trozo, re.M)
+            if len(eventos) >= cantidad:
+                break
+        await respuesta.body_iterator.aclose()
+        return eventos
+
+    return asyncio.run(asyncio.wait_for(leer(), timeout=5))
+
+
+def test_pagina_trae_la_version_de_los_datos(client):
+    antes = version_de_la_pagina(client)
+    client.post('/api/categorias', data={'nombre': 'Hierbas'})
+    assert version_de_la_pagina(client) == antes + 1
+
+
+def test_reconexion_atrasada_pide_recarga(client):
+    version = app_module.get_data_version()
+    client.post('/api/categorias', data={'nombre': 'Flores'})
+
+    assert primeros_eventos({'Last-Event-ID': str(version)}, 2) == ['conectado', 'recarga']
+
+
+def test_reconexion_al_dia_no_recarga(client):
+    version = app_module.get_data_version()
+
+    # Un cambio posterior a la conexión llega como evento normal
+    def cambio():
+        app_module.publicar_evento({'tipo': 'categorias', 'version': version + 1})
+
+    assert primeros_eventos({'Last-Event-ID': str(version)}, 2, cambio) == ['conectado', 'categorias']
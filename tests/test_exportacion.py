@@ -0,0 +1,24 @@
+import sqlite3
+
+import app as app_module
+from conftest import filas_pedido, subir
+
+ITEMS = [('Tomate', 2, 990), ('Palta', 1, 2990), ('Apio', 3, 490), ('Cilantro', 1, 490)]
+
+
+def test_descarga_pausada_no_bloquea_escrituras(client):
+    filas = []
+    for n in range(1, 201):
+        filas += filas_pedido(f'#{n}', '2030-03-04', 'Macul', ITEMS)
+    subir(client, filas)
+
+    stream = app_module._stream_exportacion([(app_module.BACKUP_CONSULTAS['lineas_pedido'], (), {})], 'jsonl')
+    primero = next(stream)  # Cliente lento: el stream queda pausado con la consulta abierta
+
+    conn = sqlite3.connect(app_module.DB_PATH, timeout=0.5)
+    conn.execute("UPDATE pedidos SET status = 'completado' WHERE order_number = '#1'")
+    conn.commit()
+    conn.close()
+
+    resto = b''.join(stream)
+    assert (primero + resto).count(b'\n') == 800
@@ -0,0 +1,99 @@
+from conftest import filas_pedido, subir
+
+FECHA = '2030-03-04'
+ITEMS = [('Tomate', 2, 990), ('Palta', 1, 2990), ('Apio', 3, 490)]
+
+
+def lineas(db, numero='#1'):
+    return db.execute('''
+        SELECT lp.id, lp.producto, lp.cantidad, lp.content_hash
+        FROM lineas_pedido lp JOIN pedidos p ON p.id = lp.pedido_id
+        WHERE p.order_number = ? ORDER BY lp.id
+    ''', (numero,)).fetchall()
+
+
+def demanda(db):
+    return db.execute("SELECT fecha, producto, comuna, cantidad, lineas FROM demanda_diaria ORDER BY 1, 2, 3").fetchall()
+
+
+def test_cantidad_cambiada_actualiza_solo_esa_linea(client, db):
+    subir(client, filas_pedido('#1', FECHA, 'Macul', ITEMS))
+    antes = {row['producto']: row['id'] for row in lineas(db)}
+
+    stats = subir(client, filas_pedido('#1', FECHA, 'Macul', [('Tomate', 5, 990)] + ITEMS[1:]), incremental=True)
+
+    assert (stats['actualizados'], stats['sin_cambios'], stats['nuevos']) == (1, 0, 0)
+    despues = {row['producto']: (row['id'], row['cantidad']) for row in lineas(db)}
+    assert despues['Palta'] == (antes['Palta'], 1)
+    assert despues['Apio'] == (antes['Apio'], 3)
+    assert despues['Tomate'][0] != antes['Tomate'] and despues['Tomate'][1] == 5
+    assert len(despues) == 3
+
+
+def test_pedido_igual_queda_sin_cambios(client, db):
+    subir(client, filas_pedido('#1', FECHA, 'Macul', ITEMS))
+    antes = lineas(db)
+
+    stats = subir(client, filas_pedido('#1', FECHA, 'Macul', ITEMS), incremental=True)
+
+    assert (stats['actualizados'], stats['sin_cambios']) == (0, 1)
+    assert [tuple(row) for row in lineas(db)] == [tuple(row) for row in antes]
+
+
+def test_pedidos_sin_hash_previos(client, db):
+    subir(client, filas_pedido('#1', FECHA, 'Macul', ITEMS))
+    db.execute("UPDATE pedidos SET content_hash = NULL")
+    db.execute("UPDATE lineas_pedido SET content_hash = NULL")
+    db.commit()
+
+    stats = subir(client, filas_pedido('#1', FECHA, 'Macul', ITEMS), incremental=True)
+    assert stats['sin_cambios'] == 1
+    assert db.execute("SELECT content_hash FROM pedidos").fetchone()[0]
+
+    ids = [row['id'] for row in lineas(db)]
+    stats = subir(client, filas_pedido('#1', FECHA, 'Macul', ITEMS + [('Cilantro', 1, 490)]), incremental=True)
+    assert stats['actualizados'] == 1
+    actuales = lineas(db)
+    assert [row['id'] for row in actuales][:3] == ids
+    assert all(row['content_hash'] for row in actuales)
+
+
+def test_postergado_conserva_su_fecha(client, db):
+    subir(client, filas_pedido('#1', FECHA, 'Macul', ITEMS))
+    pedido_id = db.execute("SELECT id FROM pedidos").fetchone()[0]
+    client.post(f'/api/pedidos/{pedido_id}/postergar', data={'nueva_fecha': '2030-03-09'})
+
+    stats = subir(client, filas_pedido('#1', '2030-03-05', 'Ñuñoa', ITEMS), incremental=True)
+
+    assert stats['actualizados'] == 1
+    pedido = db.execute("SELECT * FROM pedidos").fetchone()
+    assert (pedido['status'], pedido['fecha_entrega'], pedido['fecha_original'], pedido['comuna']) == \
+        ('postergado', '2030-03-09', '2030-03-05', 'Ñuñoa')
+
+
+def test_lineas_repetidas(client, db):
+    repetidas = [('Tomate', 1, 990), ('Tomate', 1, 990), ('Palta', 1, 2990)]
+    subir(client, filas_pedido('#1', FECHA, 'Macul', repetidas))
+
+    subir(client, filas_pedido('#1', FECHA, 'Macul', repetidas[1:]), incremental=True)
+    assert [row['producto'] for row in lineas(db)] == ['Tomate', 'Palta']
+
+    subir(client, filas_pedido('#1', FECHA, 'Macul', repetidas + [('Tomate', 1, 990)]), incremental=True)
+    assert sorted(row['producto'] for row in lineas(db)) == ['Palta', 'Tomate', 'Tomate', 'Tomate']
+
+    # Reimportar lo mismo no agrega nada
+    stats = subir(client, filas_pedido('#1', FECHA, 'Macul', repetidas + [('Tomate', 1, 990)]), incremental=True)
+    assert stats['sin_cambios'] == 1 and len(lineas(db)) == 4
+
+
+def test_demanda_y_busqueda_siguen_la_actualizacion(client, db):
+    subir(client, filas_pedido('#1', FECHA, 'Macul', ITEMS))
+    subir(client, filas_pedido('#1', '2030-03-05', 'Macul', [('Frambuesa', 2, 3990)] + ITEMS[1:]), incremental=True)
+
+    incremental = demanda(db)
+    client.post('/api/analitica/reconstruir')
+    assert [tuple(row) for row in incremental] == [tuple(row) for row in demanda(db)]
+    assert {row['fecha'] for row in incremental} == {'2030-03-05'}
+
+    assert client.get('/api/buscar', params={'q': 'frambue'}).json()['total'] == 1
+    assert client.get('/api/buscar', params={'q': 'tomate'}).json()['total'] == 0
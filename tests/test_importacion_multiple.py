@@ -0,0 +1,79 @@
+from conftest import csv_shopify, filas_pedido
+
+import app as app_module
+
+FECHA = '2030-03-04'
+ITEMS = [('Tomate', 2, 990), ('Palta', 1, 2990), ('Apio', 3, 490), ('Cilantro', 1, 490)]
+
+
+def exportacion():
+    filas = []
+    for n in range(1, 6):
+        filas += filas_pedido(f'#{n}', FECHA, 'Macul', ITEMS)
+    return filas
+
+
+def subir(client, archivos, incremental=False):
+    r = client.post(
+        '/upload-multiple',
+        files=[('files', (nombre, contenido, 'text/csv')) for nombre, contenido in archivos],
+        data={'incremental': 'true' if incremental else 'false'}
+    )
+    assert r.status_code == 200
+    return r.json()
+
+
+def lineas(db):
+    return db.execute("SELECT COUNT(*), SUM(cantidad) FROM lineas_pedido").fetchone()
+
+
+def test_pedido_cortado_entre_archivos_se_une(client, db):
+    filas = exportacion()
+    # El corte cae en medio del pedido #3 (filas 8..11)
+    partes = [csv_shopify(filas[:10]), csv_shopify(filas[10:])]
+
+    datos = subir(client, [('parte1.csv', partes[0]), ('parte2.csv', partes[1])])
+
+    assert datos['nuevos'] == 5
+    assert datos['divididos'] == 1
+    assert datos['duplicados'] == 0
+    assert tuple(lineas(db)) == (20, 35)
+    pedido = db.execute("SELECT * FROM pedidos WHERE order_number = '#3'").fetchone()
+    assert pedido['email'] == '3@example.com' and pedido['fecha_entrega'] == FECHA
+
+
+def test_archivos_solapados_no_duplican_lineas(client, db):
+    contenido = csv_shopify(exportacion())
+    subir(client, [('a.csv', contenido)])
+    antes = tuple(lineas(db))
+
+    datos = subir(client, [('a.csv', contenido), ('copia.csv', contenido)], incremental=True)
+
+    assert datos['divididos'] == 0
+    assert datos['duplicados'] == 5
+    assert datos['actualizados'] == 0
+    assert tuple(lineas(db)) == antes == (20, 35)
+
+
+def test_cola_de_pedido_repetida_no_se_suma_dos_veces():
+    filas = exportacion()
+    partes = [app_module.parse_shopify_csv(csv_shopify(f).decode()) for f in (filas[:10], filas[10:], filas[10:])]
+
+    pedidos, divididos, duplicados = app_module.fusionar_pedidos(partes)
+
+    assert divididos == 1
+    assert duplicados == 3
+    assert sum(len(p['items']) for p in pedidos) == 20
+
+
+def test_archivos_en_orden_inverso_se_unen_igual():
+    filas = exportacion()
+    partes = [app_module.parse_shopify_csv(csv_shopify(f).decode()) for f in (filas[10:], filas[:10])]
+
+    pedidos, divididos, duplicados = app_module.fusionar_pedidos(partes)
+
+    assert divididos == 1
+    assert duplicados == 0
+    pedido = next(p for p in pedidos if p['order_number'] == '#3')
+    assert pedido['fecha_entrega'] == FECHA
+    assert [item['producto'] for item in pedido['items']] == [p for p, _, _ in ITEMS]
@@ -0,0 +1,20 @@
+import pytest
+
+import loadtest
+
+
+@pytest.mark.parametrize('n, p, esperado', [
+    (100, 99, 99),
+    (20, 95, 19),
+    (10, 50, 5),
+    (10, 95, 10),
+    (1, 50, 1),
+    (3, 100, 3),
+    (3, 1, 1),
+])
+def test_percentil_por_rango_mas_cercano(n, p, esperado):
+    assert loadtest.percentil(list(range(1, n + 1)), p) == esperado
+
+
+def test_percentil_sin_valores():
+    assert loadtest.percentil([], 95) == 0.0
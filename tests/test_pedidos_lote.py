@@ -0,0 +1,59 @@
+from conftest import csv_shopify, filas_pedido
+
+FECHA = '2030-03-04'
+MANANA = '2030-03-05'
+
+
+def importar(client):
+    filas = []
+    for numero, comuna in (('#1', 'Ñuñoa'), ('#2', 'Ñuñoa'), ('#3', 'Ñuñoa'), ('#4', 'Macul')):
+        filas += filas_pedido(numero, FECHA, comuna, [('Tomate', 2, 990), ('Palta', 1, 2990)])
+    r = client.post('/upload', files={'file': ('pedidos.csv', csv_shopify(filas), 'text/csv')})
+    assert r.status_code == 200
+    ids = {row['order_number']: row['id'] for row in client.get('/api/pedidos', params={'fecha': FECHA}).json()}
+    client.post(f"/api/pedidos/{ids['#1']}/completar")
+    return ids
+
+
+def estados(db):
+    return {row['order_number']: (row['status'], row['fecha_entrega']) for row in db.execute("SELECT * FROM pedidos")}
+
+
+def test_postergar_por_filtro_no_toca_completados(client, db):
+    importar(client)
+
+    r = client.post('/api/pedidos-lote/postergar', data={'fecha': FECHA, 'comuna': 'Ñuñoa', 'nueva_fecha': MANANA})
+
+    assert r.json()['afectados'] == 2
+    assert estados(db) == {
+        '#1': ('completado', FECHA),
+        '#2': ('postergado', MANANA),
+        '#3': ('postergado', MANANA),
+        '#4': ('pendiente', FECHA),
+    }
+
+
+def test_eliminar_por_filtro_conserva_historial(client, db):
+    importar(client)
+
+    client.post('/api/pedidos-lote/eliminar', data={'fecha': FECHA})
+
+    assert estados(db) == {'#1': ('completado', FECHA)}
+
+
+def test_status_explicito_alcanza_completados(client, db):
+    importar(client)
+
+    r = client.post('/api/pedidos-lote/eliminar', data={'fecha': FECHA, 'status': 'completado'})
+
+    assert r.json()['afectados'] == 1
+    assert '#1' not in estados(db)
+
+
+def test_reactivar_por_filtro_toma_completados(client, db):
+    importar(client)
+
+    r = client.post('/api/pedidos-lote/reactivar', data={'fecha': FECHA})
+
+    assert r.json()['afectados'] == 1
+    assert estados(db)['#1'] == ('pendiente', FECHA)
@@ -0,0 +1,67 @@
+import os
+import subprocess
+import sys
+from datetime import date, timedelta
+
+import app as app_module
+from conftest import filas_pedido, subir
+
+
+def archivos():
+    return {archivo.name for archivo in app_module.dir_precalculo().iterdir()}
+
+
+def importar_y_precalcular(client, dias=2):
+    fechas = [(date.today() + timedelta(days=i)).isoformat() for i in (1, 2)]
+    subir(client, filas_pedido('#1', fechas[0], 'Macul', [('Tomate', 1, 990)]) + filas_pedido('#2', fechas[1], 'Macul', [('Apio', 1, 990)]))
+    client.post('/api/precalculo/config', data={'dias': dias, 'hora': '05:30'})
+    client.post('/api/precalculo/ejecutar')
+    return fechas
+
+
+def test_archivo_reemplazado_sobrevive_a_la_gracia(client, monkeypatch):
+    importar_y_precalcular(client)
+    anterior = app_module.cache_obtener('pedidos_armado_xlsx', (date.today() + timedelta(days=1)).isoformat())
+
+    # Una descarga recién obtuvo el archivo y en ese momento cambian los datos
+    subir(client, filas_pedido('#3', (date.today() + timedelta(days=1)).isoformat(), 'Macul', [('Palta', 1, 990)]))
+    client.post('/api/precalculo/ejecutar')
+    assert anterior.exists()
+
+    monkeypatch.setattr(app_module, 'PRECALCULO_GRACIA', 0)
+    app_module.limpiar_precalculo()
+    assert not anterior.exists()
+
+
+def test_fechas_fuera_de_la_ventana_y_huerfanos_se_borran(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'PRECALCULO_GRACIA', 0)
+    huerfano = app_module.dir_precalculo() / 'lista_compras_2000-01-01_v1.xlsx'
+    huerfano.write_bytes(b'')
+
+    fechas = importar_y_precalcular(client, dias=2)
+    assert not huerfano.exists()
+    assert all(any(fecha in nombre for nombre in archivos()) for fecha in fechas)
+
+    client.post('/api/precalculo/config', data={'dias': 1, 'hora': '05:30'})
+    client.post('/api/precalculo/ejecutar')
+    assert archivos() and all(fechas[0] in nombre for nombre in archivos())
+
+
+def test_no_toca_archivos_de_otros_procesos(client):
+    otro = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+    try:
+        vivo = app_module.PRECALCULO_DIR / str(otro.pid)
+        vivo.mkdir(parents=True, exist_ok=True)
+        (vivo / 'lista_compras_2030-01-01_v1.xlsx').write_bytes(b'')
+        muerto = app_module.PRECALCULO_DIR / '999999999'
+        muerto.mkdir(parents=True, exist_ok=True)
+        (muerto / 'lista_compras_2030-01-01_v1.xlsx').write_bytes(b'')
+
+        app_module.limpiar_precalculo()
+
+        assert (vivo / 'lista_compras_2030-01-01_v1.xlsx').exists()
+        assert not muerto.exists()
+    finally:
+        otro.kill()
+        otro.wait()
+    assert str(os.getpid()) in {d.name for d in app_module.PRECALCULO_DIR.iterdir()}
@@ -0,0 +1,24 @@
+from conftest import csv_shopify, filas_pedido
+
+FECHA = '2030-03-04'
+
+
+def productos(db):
+    return dict(db.execute("SELECT producto, lineas FROM productos").fetchall())
+
+
+def test_productos_sin_categoria_sigue_a_los_pedidos(client, db):
+    filas = filas_pedido('#1', FECHA, 'Macul', [('Tomate', 1, 990), ('Apio', 2, 490)])
+    filas += filas_pedido('#2', FECHA, 'Macul', [('Tomate', 3, 990), ('Cilantro', 1, 490)])
+    client.post('/upload', files={'file': ('pedidos.csv', csv_shopify(filas), 'text/csv')})
+    client.post('/api/asignar-categoria', data={'producto': 'Tomate', 'categoria_id': 2})
+
+    assert client.get('/api/productos-sin-categoria').json() == ['Apio', 'Cilantro']
+
+    ids = {row['order_number']: row['id'] for row in client.get('/api/pedidos', params={'fecha': FECHA}).json()}
+    client.delete(f"/api/pedidos/{ids['#2']}")
+
+    assert client.get('/api/productos-sin-categoria').json() == ['Apio']
+    incremental = productos(db)
+    client.post('/api/analitica/reconstruir')
+    assert incremental == productos(db) == {'Tomate': 1, 'Apio': 1}